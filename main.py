@@ -1,18 +1,25 @@
 import os, subprocess, argparse, sys
-from sys import stderr, stdout
-from src.python.life_table import generate_life_table
-from src.python.country_table import generate_country_table
-from src.python.helper import DOWNLOAD_FOLDER as raw, OUTPUT_FOLDER as processed, R_PATH, SETTINGS
-from src.python import log  
+import pandas as pd
+from src.python import hmd, hfd, hg, income_status, life_table, country_table, life_table_derivatives, generation_time_ne
+from src.python.pipeline import Stage
+from src.python.r_session import RSession
+from src.python.helper import DOWNLOAD_FOLDER as raw, OUTPUT_FOLDER as processed, R_PATH, SETTINGS, out_path
+from src.python import log, cache, pipeline, refresh, profiler, table_io, dashboard, selection
     
 
 life_table_derivatives_R = "src/R/life_table_derivatives.R"
 generation_time_R = "src/R/generation_time.R"
 ne_felsenstein_R = "src/R/ne_felsenstein.R"
+mx_shape_metrics_R = "src/R/mx_shape_metrics.R"
+prr_calculation_R = "src/R/prr_calculation.R"
 plots_Ne_T_by_group_R = "src/R/plots_Ne_T_by_group.R"
+io_R = "src/R/io.R" # read_table/write_table shared by the R scripts
+table_io_py = "src/python/table_io.py" # writes and loads the tables of every python stage
 
 out_dir = "outputs"
 
+r_session = None # shared RSession when r_mode is "session"
+
 
 def run_r(path: str, *args: str):
     version = SETTINGS["r_version"]
@@ -42,6 +49,127 @@ def run_r(path: str, *args: str):
         log.error(f"R script failed: {os.path.basename(path)} (exit {res.returncode}). [R stderr] {res.stderr.strip()}")
 
 
+def run_life_table(results):
+    df = life_table.combine_life_table(results["hmd"], results["hfd"], results["hg"])
+    life_table.write_life_table(df)
+    return df
+
+
+def run_country_table(results):
+    df = country_table.format_country_table(results["income_status"], results["life_table"])
+    country_table.write_country_table(df)
+    return df
+
+
+def run_keyfitz(results, workers):
+    df, ex_df = country_table.add_keyfitz_H(results["country_table"], results["life_table"], workers)
+    country_table.write_remaining_life_expectancy(ex_df)
+    country_table.write_country_table(df)
+    return df
+
+
+def table_or_path(results, name: str, path: str):
+    # the table a python stage returned, or its written file when the stage ran in R (or was skipped without a loader)
+    df = results[name]
+    return df if isinstance(df, pd.DataFrame) else path
+
+
+def derivatives_stage(args, life_table_path) -> Stage:
+    # compute fields like dx, sx, qx etc... either in-process or with life_table_derivatives.R
+    backend = args.derivatives or SETTINGS.get("derivatives_backend", "r")
+
+    if backend == "python":
+        return Stage("derivatives", lambda r: life_table_derivatives.generate_life_table_derivatives(r["life_table"], life_table_path),
+                     outputs=table_io.files("life_table"), deps=["life_table"], code=["src/python/life_table_derivatives.py", table_io_py])
+
+    return Stage("derivatives", lambda r: run_r_script(life_table_derivatives_R, life_table_path),
+                 outputs=table_io.files("life_table"), deps=["life_table"], code=[life_table_derivatives_R, io_R])
+
+
+def generation_time_ne_stages(args, life_table_path, country_table_path) -> list:
+    # generation time T and Felsenstein Ne, either in-process or with generation_time.R and ne_felsenstein.R
+    backend = args.t_ne or SETTINGS.get("t_ne_backend", "r")
+
+    if backend == "python":
+        code = ["src/python/generation_time_ne.py", table_io_py]
+        return [
+            Stage("generation_time", lambda r: generation_time_ne.generate_generation_time(table_or_path(r, "derivatives", life_table_path), table_or_path(r, "keyfitz", country_table_path)),
+                  outputs=table_io.files("country_table"), deps=["derivatives", "keyfitz"], code=code),
+            Stage("ne_felsenstein", lambda r: generation_time_ne.generate_ne(table_or_path(r, "derivatives", life_table_path), table_or_path(r, "generation_time", country_table_path)),
+                  outputs=table_io.files("country_table"), deps=["derivatives", "generation_time"], code=code),
+        ]
+
+    return [
+        Stage("generation_time", lambda r: run_r_script(generation_time_R, life_table_path, country_table_path), # calculation generation time
+              outputs=table_io.files("country_table"), deps=["derivatives", "keyfitz"], code=[generation_time_R, io_R]),
+        Stage("ne_felsenstein", lambda r: run_r_script(ne_felsenstein_R, life_table_path, country_table_path), # calculate Ne according to felsenstein
+              outputs=table_io.files("country_table"), deps=["derivatives", "generation_time"], code=[ne_felsenstein_R, io_R]),
+    ]
+
+
+def build_stages(args) -> list:
+    """
+    stage graph of the pipeline, in run order
+    each stage declares what it reads so unchanged stages can be reused by pipeline.run
+    """
+    life_table_path = os.path.join(out_path(), "life_table.csv")
+    country_table_path = os.path.join(out_path(), "country_table.csv")
+    py = "src/python"
+
+    return [
+        # python prep, the raw file of a source that is not selected is not looked for (it may not be downloaded)
+        Stage("hmd", lambda r: hmd.generate_hmd_df(False),
+              outputs=table_io.files("hmd"), inputs=[hmd.find_hmd_file(hmd.download_path)] if selection.includes("HMD") else [],
+              code=[f"{py}/hmd.py", f"{py}/hmd_hfd_reader.py", f"{py}/schema.py", f"{py}/selection.py", f"{py}/cache.py", table_io_py], settings=["include_edge_data", "float_dtype", "csv_export", "partition_tables", *selection.KEYS],
+              load=table_io.loader()),
+        Stage("hfd", lambda r: hfd.generate_hfd_df(False),
+              outputs=table_io.files("hfd"), inputs=[hfd.find_hfd_file(hfd.download_path)] if selection.includes("HFD") else [],
+              code=[f"{py}/hfd.py", f"{py}/hmd_hfd_reader.py", f"{py}/schema.py", f"{py}/selection.py", f"{py}/cache.py", table_io_py], settings=["include_edge_data", "float_dtype", "csv_export", "partition_tables", *selection.KEYS],
+              load=table_io.loader()),
+        Stage("hg", lambda r: hg.generate_hg_df(),
+              outputs=table_io.files("hg"), inputs=[hg.HG_DATA_DIR],
+              code=[f"{py}/hg.py", f"{py}/schema.py", f"{py}/selection.py", f"{py}/cache.py", table_io_py], settings=["min_age", "max_age", "float_dtype", "csv_export", "partition_tables", *selection.KEYS],
+              load=table_io.loader()), # no hg table when there is no HG data
+        Stage("income_status", lambda r: income_status.generate_income_status_df(False)[0],
+              outputs=table_io.files("income_status"), inputs=[income_status.download_path],
+              code=[f"{py}/income_status.py", f"{py}/selection.py", f"{py}/cache.py", table_io_py], settings=["csv_export", "partition_tables", *selection.KEYS],
+              load=table_io.loader(lambda path: table_io.read_table(path, lambda csv: pd.read_csv(csv, keep_default_na=False)))), # IS is written as "NA", keep it as text
+        Stage("life_table", run_life_table,
+              outputs=table_io.files("life_table"), deps=["hmd", "hfd", "hg"],
+              code=[f"{py}/life_table.py", f"{py}/schema.py", table_io_py], settings=["min_age", "max_age"],
+              load=table_io.loader(country_table.load_life_table)),
+        derivatives_stage(args, life_table_path),
+        Stage("country_table", run_country_table,
+              outputs=table_io.files("country_table"), deps=["life_table", "income_status"],
+              code=[f"{py}/country_table.py", table_io_py],
+              load=table_io.loader(country_table.load_country_table)),
+        Stage("keyfitz", lambda r: run_keyfitz(r, args.workers),
+              outputs=[*table_io.files("country_table"), *table_io.files("remaining_life_expectancy")], deps=["life_table", "country_table"],
+              code=[f"{py}/country_table.py", f"{py}/Keyfitz_entropy.py", table_io_py]),
+
+        # r analysis, every script rewrites the country table in place (read and written with src/R/io.R)
+        *generation_time_ne_stages(args, life_table_path, country_table_path),
+        Stage("mx_shape_metrics", lambda r: run_r_script(mx_shape_metrics_R, life_table_path, country_table_path), #calculate mx with skew
+              outputs=table_io.files("country_table"), deps=["derivatives", "ne_felsenstein"], code=[mx_shape_metrics_R, io_R]),
+        Stage("prr_calculation", lambda r: run_r_script(prr_calculation_R, life_table_path, country_table_path),
+              outputs=table_io.files("country_table"), deps=["derivatives", "mx_shape_metrics"], code=[prr_calculation_R, io_R]),
+
+        # aggregates and per-country slices of the final tables, so the Shiny app does not scan them at start
+        Stage("dashboard", lambda r: dashboard.generate_dashboard_store(life_table_path, country_table_path),
+              outputs=[dashboard.DASHBOARD_FOLDER], deps=["derivatives", "prr_calculation"],
+              code=[f"{py}/dashboard.py", f"{py}/country_table.py", table_io_py], settings=["csv_export", "partition_tables"]),
+    ]
+
+
+def run_r_script(path: str, *args: str):
+    # run in the shared R session when there is one, otherwise in a fresh Rscript process
+    with profiler.section(f"R:{os.path.basename(path)}") as section:
+        section.inputs(*args)
+        if r_session is not None: r_session.run(path, *args)
+        else: run_r(path, *args)
+        section.outputs(*args)
+
+
 def env_contains_values():
     # check if .env has email and password and exists
     try:
@@ -55,13 +183,6 @@ def env_contains_values():
     
     
 if __name__ == "__main__":
-    #debug
-    import os
-    log.log(f"Python is running from: {os.getcwd()}")
-    log.log(f"ShinyPipeline.R exists here: {os.path.exists('ShinyPipeline.R')}")
-    
-
-
      # if .env is not correct, generate
     if not env_contains_values():
         email = input("Enter your email (HMD/HFD): ")
@@ -73,30 +194,71 @@ if __name__ == "__main__":
         
         # rerun the program
         os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    # start this run's output folder (data/processed/dataN) so everything is logged to it
+    out_path()
+
+    #debug
+    log.log(f"Python is running from: {os.getcwd()}")
+    log.log(f"ShinyPipeline.R exists here: {os.path.exists('ShinyPipeline.R')}")
         
     parser = argparse.ArgumentParser()
     parser.add_argument("--download", action="store_true", help="Download data")
+    parser.add_argument("--workers", type=int, default=None, help="Processes used for H_N (overrides keyfitz_workers in settings.json5)")
+    parser.add_argument("--no-cache", action="store_true", help="Re-parse raw data instead of using data/cache")
+    parser.add_argument("--derivatives", choices=["r", "python"], default=None, help="Backend for life table derivatives (overrides derivatives_backend in settings.json5)")
+    parser.add_argument("--t-ne", choices=["r", "python"], default=None, help="Backend for generation time and Ne (overrides t_ne_backend in settings.json5)")
+    parser.add_argument("--r-session", action="store_true", help="Run all R scripts in one R process (same as r_mode: \"session\" in settings.json5)")
+    parser.add_argument("--force", action="store_true", help="Rerun every stage even if its inputs are unchanged")
+    parser.add_argument("--cprofile", action="store_true", help="Also write function level cProfile stats (profile.prof) to the run folder")
+    parser.add_argument("--log-level", choices=list(log.LEVELS), default=None, help="Lowest level logged (overrides log_level in settings.json5)")
+    # subset of the data, applied while the raw files are read (override the same keys in settings.json5)
+    parser.add_argument("--countries", nargs="+", default=None, metavar="ISO3", help="Only these countries, e.g. DEU FRA (HG populations: ACH HDZ KUN)")
+    parser.add_argument("--suffixes", nargs="+", default=None, metavar="SUFFIX", help=f"Only these population suffixes, e.g. TE TNP, '{selection.NO_SUFFIX}' for populations without one")
+    parser.add_argument("--years", type=selection.parse_years, default=None, metavar="FIRST-LAST", help="Only these years, e.g. 1950-2000, 1990, 1950- or -2000")
+    parser.add_argument("--sources", nargs="+", type=str.upper, choices=selection.SOURCES, default=None, help="Only these data sources")
     args = parser.parse_args()
 
+    if args.log_level: log.set_level(args.log_level)
+
+    if args.cprofile: profiler.start_cprofile()
+
+    cache.set_enabled(not args.no_cache)
+
+    selection.apply_arguments(args)
+    if selection.active(): log.log(f"processing a subset: {selection.describe()}")
+
     # make sure folders exist
     for p in (raw, processed, "outputs"):
         os.makedirs(p, exist_ok=True)
 
-    # python prep
-    log.log("=== python pipeline: start ===")
-    life_table_path = generate_life_table(args.download)
-    country_table_path = generate_country_table(life_table_path, args.download)
-    log.log("=== python pipeline: done ===")
-
-    # r analysis
-    log.log("=== r pipeline: start ===")
-
-    # generate data
-    run_r(life_table_derivatives_R, life_table_path) # compute fields like dx, sx, qx etc...
-    run_r(generation_time_R, life_table_path, country_table_path) # calculation generation time
-    run_r(ne_felsenstein_R, life_table_path, country_table_path) # calculate Ne according to felsenstein
-    run_r("src/R/mx_shape_metrics.R", life_table_path, country_table_path) #calculate mx with skew
-    run_r("src/R/prr_calculation.R", life_table_path, country_table_path)
+    # fetch HMD, HFD and WBLG concurrently, sources unchanged since the last download are skipped
+    if args.download:
+        try:
+            refresh.refresh()
+        except log.PipelineError:
+            sys.exit(1) # already logged
+
+    # python prep and r analysis, stages with unchanged inputs reuse their last outputs
+    life_table_path = os.path.join(out_path(), "life_table.csv")
+    country_table_path = os.path.join(out_path(), "country_table.csv")
+
+    # R starts on the first R stage that has to run, then loads both tables once
+    if args.r_session or SETTINGS.get("r_mode") == "session":
+        r_session = RSession(life_table_path, country_table_path)
+
+    log.log("=== pipeline: start ===")
+    try:
+        pipeline.run(build_stages(args), force=args.force)
+    except log.PipelineError:
+        sys.exit(1) # already logged, the stages that finished keep their outputs
+    finally:
+        if r_session is not None: r_session.close()
+        # per stage wall/cpu time, peak memory and rows/bytes in and out, also for failed runs
+        profiler.write(out_path())
+        log.log(f"stage profile (slowest first):\n{profiler.summary()}")
+    log.log("=== pipeline: done ===")
+
     # plot data; had to get rid of run r as r needs to keep running for r shiny
     
     log.log(f"SHINY_DATA_DIR is set to: {processed}")
@@ -120,9 +282,11 @@ if __name__ == "__main__":
     time.sleep(5)
    
     if shiny_process.poll() is not None:
-        log.error(f"Shiny crashed Exit code {shiny_process.returncode}")
-        log.error(f"R stdout: {stdout}")
-        log.error(f"R stderr: {stderr}")
+        shiny_stdout, shiny_stderr = shiny_process.communicate()
+        try:
+            log.error(f"Shiny crashed Exit code {shiny_process.returncode}. [R stdout] {shiny_stdout.strip()} [R stderr] {shiny_stderr.strip()}")
+        except log.PipelineError:
+            sys.exit(1) # already logged
 
     else:
         log.log("Shiny process is running!")
@@ -130,6 +294,6 @@ if __name__ == "__main__":
         log.log("Press Ctrl=c in the treminal to stop the app")
         shiny_process.wait()
 
-log.log("== r pipeline: done ==")
+    log.log("== r pipeline: done ==")
    
 
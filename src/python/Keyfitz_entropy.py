@@ -1,6 +1,9 @@
 import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from src.python import log
+from src.python.helper import SETTINGS
+from src.python.schema import fill_category
 
 def calculate_keyfitz_H(lx_values):
     """
@@ -65,9 +68,9 @@ def calculate_keyfitz_H(lx_values):
     return numerator / denominator
 
 
-def calculate_H_for_dataset(life_table_df):
+def stack_lx(life_table_df):
     """
-    Calculate Keyfitz H for each (ISO3, ISO3_suffix, Year) in the life table.
+    Stack the lx schedule of every (ISO3, ISO3_suffix, Year) into one array.
     
     Parameters:
     -----------
@@ -76,54 +79,336 @@ def calculate_H_for_dataset(life_table_df):
     
     Returns:
     --------
-    H_df : pd.DataFrame
-        DataFrame with columns: ISO3, ISO3_suffix, Year, H_N
+    keys : pd.DataFrame
+        One row per country-year with columns: ISO3, ISO3_suffix, Year
+    lx : np.ndarray
+        (groups x ages) array of lx sorted by age, padded with NaN
+    lengths : np.ndarray
+        Number of ages present for each group
     """
+    key_cols = ['ISO3', 'ISO3_suffix', 'Year']
+    df = life_table_df[[*key_cols, 'Age', 'lx']].sort_values([*key_cols, 'Age'], kind='stable')
+    
     # Handle NaN in ISO3_suffix
-    life_table_df['ISO3_suffix'] = life_table_df['ISO3_suffix'].fillna('')
+    df['ISO3_suffix'] = fill_category(df['ISO3_suffix'], '')
+    
+    # row -> (group, position within group) without looping over groups
+    grouped = df.groupby(key_cols, sort=False, dropna=False, observed=True)
+    group_idx = grouped.ngroup().to_numpy()
+    position = grouped.cumcount().to_numpy()
+    
+    keys = df.loc[~pd.Series(group_idx).duplicated().to_numpy(), key_cols].reset_index(drop=True)
+    lengths = np.bincount(group_idx, minlength=len(keys))
+    
+    lx = np.full((len(keys), lengths.max(initial=0)), np.nan, dtype=np.float64)
+    lx[group_idx, position] = pd.to_numeric(df['lx'], errors='coerce').to_numpy(dtype=np.float64)
+    
+    return keys, lx, lengths
+
+
+# columns of calculate_survivorship_batch, in order
+SURVIVORSHIP_METRICS = ['H_N', 'e0', 'e_N', 'e_dagger', 'V_N']
+
+
+def calculate_survivorship_batch(lx, lengths, per_age=False):
+    """
+    Calculate the survivorship metrics of the fundamental matrix N for many
+    lx schedules at once, in one pass over the stacked array. Uses the
+    subdiagonal structure of U instead of inverting I - U:
+        N e1      = cumulative product of p (survivorship from age 1)
+        e^T N     = reverse cumulative sum of N e1, divided by N e1
+    
+    Metrics (columns, in SURVIVORSHIP_METRICS order):
+        H_N       Keyfitz entropy, e_dagger / e_N (Giaimo 2024 Eq. 2)
+        e0        life expectancy at birth, 1 + p0 e_N
+        e_N       life expectancy from age 1, e^T N e1
+        e_dagger  life disparity, e^T N M N e1: remaining life expectancy lost at each death
+        V_N       variance of the lifespan from age 1, from the second moment e^T N (2N - I) e1
+    
+    Parameters:
+    -----------
+    lx : np.ndarray
+        (groups x ages) array of lx from age 0, as returned by stack_lx
+    lengths : np.ndarray
+        Number of valid ages in each row of lx
+    per_age : bool
+        Also return the remaining life expectancy at every age
+    
+    Returns:
+    --------
+    metrics : np.ndarray
+        (groups x metrics) array, NaN where the metrics cannot be calculated
+    ex : np.ndarray, only when per_age
+        (groups x ages) array of the remaining life expectancy at each age from age 0
+        (e0, then e^T N), NaN beyond the last age and once the cohort is extinct
+    """
+    lx = np.asarray(lx, dtype=np.float64)
+    lengths = np.asarray(lengths)
+    n_groups = lx.shape[0]
+    
+    # STEP 1: Remove age 0, start from age 1
+    l = lx[:, 1:]
+    omega = lengths - 1
+    
+    if l.shape[1] < 2:
+        metrics = np.full((n_groups, len(SURVIVORSHIP_METRICS)), np.nan)
+        return (metrics, np.full(lx.shape, np.nan)) if per_age else metrics
+    
+    # STEP 2: p[a] = l[a+1] / l[a], zero at the last age of each group and beyond
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = np.where(l[:, :-1] > 0, l[:, 1:] / l[:, :-1], 0)
+        p0 = np.where(lx[:, 0] > 0, lx[:, 1] / lx[:, 0], 0)
+    p = np.concatenate([p, np.zeros((n_groups, 1))], axis=1)
+    ages = np.arange(p.shape[1])
+    p[ages >= (omega - 1)[:, None]] = 0
+    
+    # STEP 3: N e1, survivorship from the first age (column 0 of N)
+    s = np.ones_like(p)
+    s[:, 1:] = np.cumprod(p[:, :-1], axis=1)
+    
+    # STEP 4: e^T N, expected remaining time in the chain from each age
+    tail = np.cumsum(s[:, ::-1], axis=1)[:, ::-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        eta = np.where(s != 0, tail / s, 0)
+    
+    # STEP 5: e^T N e1 and e^T N M N e1, with M = diag(1 - p)
+    e_N = tail[:, 0]
+    e_dagger = np.sum(eta * (1 - p) * s, axis=1)
+    
+    # STEP 6: second moment e^T N (2N - I) e1 = 2 (e^T N) (N e1) - e^T N e1
+    V_N = 2 * np.sum(tail, axis=1) - e_N - e_N ** 2
+    
+    # STEP 7: one more step of the chain back to age 0
+    e0 = 1 + p0 * e_N
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        H = np.where(e_N != 0, e_dagger / e_N, np.nan)
+    
+    metrics = np.column_stack([H, e0, e_N, e_dagger, V_N])
+    
+    # same guard as calculate_keyfitz_H: at least 2 ages after age 0
+    invalid = omega < 2
+    metrics[invalid] = np.nan
+    if not per_age:
+        return metrics
+    
+    ex = np.column_stack([e0, np.where((s != 0) & (ages < omega[:, None]), eta, np.nan)])
+    ex[invalid] = np.nan
+    return metrics, ex
+
+
+def calculate_keyfitz_H_batch(lx, lengths):
+    """
+    Calculate Keyfitz entropy H_N for many lx schedules at once.
+    Gives the same result as calculate_keyfitz_H row by row, see
+    calculate_survivorship_batch for the other metrics of the same pass.
+    
+    Parameters:
+    -----------
+    lx : np.ndarray
+        (groups x ages) array of lx from age 0, as returned by stack_lx
+    lengths : np.ndarray
+        Number of valid ages in each row of lx
+    
+    Returns:
+    --------
+    H : np.ndarray
+        Keyfitz entropy H_N for every group (NaN where it cannot be calculated)
+    """
+    return calculate_survivorship_batch(lx, lengths)[:, SURVIVORSHIP_METRICS.index('H_N')]
+
+
+def calculate_H_parallel(lx, lengths, workers, per_age=False):
+    """
+    Calculate the survivorship metrics with calculate_survivorship_batch over
+    a process pool. Groups are split into contiguous chunks and only the lx
+    arrays are sent to the workers; results are written back in the original order.
+    
+    Parameters:
+    -----------
+    lx : np.ndarray
+        (groups x ages) array of lx from age 0, as returned by stack_lx
+    lengths : np.ndarray
+        Number of valid ages in each row of lx
+    workers : int
+        Number of worker processes
+    per_age : bool
+        Also return the remaining life expectancy at every age
     
-    # Group by country-year
-    grouped = life_table_df.groupby(['ISO3', 'ISO3_suffix', 'Year'], dropna=False)
-    total_groups = len(grouped)
+    Returns:
+    --------
+    metrics : np.ndarray
+        (groups x metrics) array in SURVIVORSHIP_METRICS order, in the same order as lx
+    ex : np.ndarray, only when per_age
+        (groups x ages) remaining life expectancy, see calculate_survivorship_batch
+    """
+    total_groups = len(lengths)
+    metrics = np.full((total_groups, len(SURVIVORSHIP_METRICS)), np.nan)
+    ex = np.full(lx.shape, np.nan)
+    
+    # a few chunks per worker so progress can be reported as they finish
+    bounds = np.linspace(0, total_groups, min(total_groups, workers * 4) + 1).astype(int)
+    chunks = [(a, b) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+    
+    with ProcessPoolExecutor(max_workers=workers, **log.worker_pool()) as pool:
+        futures = {
+            pool.submit(calculate_survivorship_batch, lx[a:b], lengths[a:b], per_age): (a, b)
+            for a, b in chunks
+        }
+        
+        done = 0
+        for future in as_completed(futures):
+            a, b = futures[future]
+            if per_age: metrics[a:b], ex[a:b] = future.result()
+            else: metrics[a:b] = future.result()
+            
+            done += b - a
+            log.log(f"Progress: {done}/{total_groups} ({done / total_groups * 100:.1f}%) across {workers} workers",
+                    done=done, total=total_groups)
+    
+    return (metrics, ex) if per_age else metrics
+
+
+def calculate_H_for_dataset(life_table_df, workers=None, per_age=False):
+    """
+    Calculate Keyfitz H and the other survivorship metrics for each
+    (ISO3, ISO3_suffix, Year) in the life table.
+    All country-years are stacked and solved in one vectorized pass, or split
+    over a process pool when more than one worker is requested.
+    
+    Parameters:
+    -----------
+    life_table_df : pd.DataFrame
+        Life table with columns: ISO3, ISO3_suffix, Year, Age, lx
+    workers : int, optional
+        Number of worker processes, defaults to keyfitz_workers in settings.json5
+    per_age : bool
+        Also return the remaining life expectancy at every age, from the same pass
+    
+    Returns:
+    --------
+    H_df : pd.DataFrame
+        DataFrame with columns: ISO3, ISO3_suffix, Year, H_N, e0, e_N, e_dagger, V_N
+    ex_df : pd.DataFrame, only when per_age
+        Wide DataFrame with columns: ISO3, ISO3_suffix, Year, e_0, e_1, ... (one per age from age 0)
+    """
+    if workers is None:
+        workers = SETTINGS.get("keyfitz_workers", 1)
+    
+    keys, lx, lengths = stack_lx(life_table_df)
+    total_groups = len(keys)
     
     log.log(f"Processing {total_groups} country-year combinations...")
     
-    # Pre-allocate results list with expected size (faster than appending)
-    results = []
+    if workers > 1 and total_groups > 1:
+        result = calculate_H_parallel(lx, lengths, workers, per_age)
+    else:
+        result = calculate_survivorship_batch(lx, lengths, per_age)
+    metrics, ex = result if per_age else (result, None)
+    keys[SURVIVORSHIP_METRICS] = metrics
+    
+    # Only keep successful calculations
+    ok = keys['H_N'].notna().to_numpy()
+    H_df = keys[ok].reset_index(drop=True)
     
-    # Progress tracking
-    last_log = 0
-    log_interval = max(1, total_groups // 20)  # Log ~20 times total
+    log.log(f"Completed! Successfully calculated H for {len(H_df)}/{total_groups} country-years")
+    if not per_age:
+        return H_df
     
-    for i, ((iso3, suffix, year), group) in enumerate(grouped):
-        # Progress logging every 5%
-        if i - last_log >= log_interval:
-            percent = (i / total_groups) * 100
-            log.log(f"Progress: {i}/{total_groups} ({percent:.1f}%)")
-            last_log = i
+    ex_columns = pd.DataFrame(ex[ok], columns=[f"e_{age}" for age in range(ex.shape[1])])
+    ex_df = pd.concat([H_df[['ISO3', 'ISO3_suffix', 'Year']], ex_columns], axis=1)
+    return H_df, ex_df
+
+
+def random_schedules(seed=0, size=200):
+    """
+    Random lx schedules of 1 to 111 ages, some extinct before the last age,
+    stacked as stack_lx does. Used by the parity tests.
+    """
+    rng = np.random.default_rng(seed)
+    schedules = []
+    for n in rng.integers(1, 112, size=size):
+        lx = np.cumprod(np.r_[1.0, rng.uniform(0.8, 1.0, size=n - 1)])
+        if rng.random() < 0.1:
+            lx[rng.integers(1, n) if n > 1 else 0:] = 0  # extinct before the last age
+        schedules.append(lx)
+    
+    lengths = np.array([len(lx) for lx in schedules])
+    stacked = np.full((len(schedules), lengths.max()), np.nan)
+    for i, lx in enumerate(schedules):
+        stacked[i, :len(lx)] = lx
+    
+    return schedules, stacked, lengths
+
+
+def test_keyfitz_batch_parity():
+    """
+    Check calculate_keyfitz_H_batch against calculate_keyfitz_H on random schedules.
+    """
+    log.log("Testing batched Keyfitz H against the matrix method...")
+    
+    schedules, stacked, lengths = random_schedules()
+    
+    expected = np.array([calculate_keyfitz_H(lx) for lx in schedules])
+    actual = calculate_keyfitz_H_batch(stacked, lengths)
+    
+    ok = np.allclose(actual, expected, rtol=1e-9, atol=1e-12, equal_nan=True)
+    log.log(f"  max abs difference: {np.nanmax(np.abs(actual - expected)):.3e}")
+    log.log(f"  batched and matrix H_N agree: {ok}")
+    
+    return ok
+
+
+def test_survivorship_parity():
+    """
+    Check every column of calculate_survivorship_batch against the moments of
+    the fundamental matrix N = (I - U)^-1, built explicitly for each schedule.
+    """
+    log.log("Testing batched survivorship metrics against the fundamental matrix...")
+    
+    schedules, stacked, lengths = random_schedules(seed=1, size=100)
+    
+    expected = np.full((len(schedules), len(SURVIVORSHIP_METRICS)), np.nan)
+    expected_ex = np.full(stacked.shape, np.nan)
+    for i, lx in enumerate(schedules):
+        l = lx[1:]
+        omega = len(l)
+        if omega < 2:
+            continue
         
-        # Sort by age
-        group = group.sort_values('Age')
-        lx_values = group['lx'].values
+        p = np.zeros(omega)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            p[:-1] = np.where(l[:-1] > 0, l[1:] / l[:-1], 0)
+        I = np.eye(omega)
+        N = np.linalg.inv(I - np.diag(p[:-1], k=-1))
+        e, e1 = np.ones(omega), I[:, 0]
         
-        # Quick validation
-        if len(lx_values) < 2:
-            continue
+        e_N = e @ N @ e1
+        e_dagger = e @ N @ np.diag(1 - p) @ N @ e1
+        V_N = e @ N @ (2 * N - I) @ e1 - e_N ** 2
         
-        # Calculate H_N
-        H_N = calculate_keyfitz_H(lx_values)
+        # e0 from the chain that starts at age 0
+        p0 = l[0] / lx[0] if lx[0] > 0 else 0
+        N0 = np.linalg.inv(np.eye(omega + 1) - np.diag(np.r_[p0, p[:-1]], k=-1))
+        e0 = N0.sum(axis=0)[0]
+        expected[i] = [e_dagger / e_N, e0, e_N, e_dagger, V_N]
         
-        # Only add successful calculations
-        if not np.isnan(H_N):
-            results.append({
-                'ISO3': iso3,
-                'ISO3_suffix': suffix if pd.notna(suffix) else '',
-                'Year': year,
-                'H_N': H_N
-            })
+        # remaining life expectancy from each age while the cohort is alive: (e^T N)_a
+        alive = N @ e1 != 0
+        expected_ex[i, 0] = e0
+        expected_ex[i, 1:omega + 1][alive] = (e @ N)[alive]
+    
+    actual, actual_ex = calculate_survivorship_batch(stacked, lengths, per_age=True)
+    
+    ok = np.allclose(actual, expected, rtol=1e-9, atol=1e-9, equal_nan=True)
+    for j, metric in enumerate(SURVIVORSHIP_METRICS):
+        log.log(f"  {metric} max abs difference: {np.nanmax(np.abs(actual[:, j] - expected[:, j])):.3e}")
+    
+    ok_ex = np.allclose(actual_ex, expected_ex, rtol=1e-9, atol=1e-9, equal_nan=True)
+    log.log(f"  e_x max abs difference: {np.nanmax(np.abs(actual_ex - expected_ex)):.3e}")
+    log.log(f"  batched and matrix metrics agree: {ok and ok_ex}")
     
-    log.log(f"Completed! Successfully calculated H for {len(results)}/{total_groups} country-years")
-    return pd.DataFrame(results)
+    return ok and ok_ex
 
 
 def test_keyfitz_calculation():
@@ -173,4 +458,6 @@ def test_keyfitz_calculation():
 
 
 if __name__ == "__main__":
-    test_keyfitz_calculation()
\ No newline at end of file
+    test_keyfitz_calculation()
+    test_keyfitz_batch_parity()
+    test_survivorship_parity()
\ No newline at end of file
@@ -0,0 +1,372 @@
+import os, sys, json, time, platform, string, subprocess, tempfile, tracemalloc
+import numpy as np
+import pandas as pd
+from src.python import log, schema
+from src.python.helper import SETTINGS, get_datetimestamp
+
+
+REAL_COUNTRY_YEARS = 5000 # about the size of the HMD female 1x1 life tables, scale 1
+YEARS = np.arange(1850, 2020, dtype=np.int16)
+HFD_FIRST_YEAR = 1900 # the HFD covers fewer years than the HMD
+HMD_AGES = [str(a) for a in range(110)] + ["110+"]
+HFD_AGES = ["12-"] + [str(a) for a in range(13, 55)] + ["55+"]
+# HG tables as hg.py discovers them: the real populations come as workbooks, a CSV one checks the other parser
+HG_FILES = ["Ache - Hurtado & Hill.xlsx", "Hadza - Blurton Jones data.xlsx", "!Kung - data.xlsx", "Agta - data.csv"]
+WBLG_ROWS = 218 # economies in the World Bank lending groups sheet
+
+BENCHMARK_FOLDER = "data/benchmarks" # result files, one per run
+
+
+def synthetic_tables(country_years: int, seed: int = 0):
+    '''
+    formatted HMD and HFD tables (as returned by format_hmd/format_hfd) for about country_years
+    country-years, split over populations with and without a suffix, with HFD covering most of them
+    '''
+    rng = np.random.default_rng(seed)
+    years = YEARS
+    populations = max(1, -(-country_years // len(years)))
+    codes = pd.Series([f"C{i // 2:03d}" + ("TE" if i % 2 else "") for i in range(populations)])
+    iso3, suffix = schema.split_code(codes)
+
+    pop = np.repeat(np.arange(populations), len(years))[:country_years]
+    year = np.tile(years, populations)[:country_years]
+
+    # HMD: ages 0..110 for every country-year
+    ages = np.arange(0, 111, dtype=np.int16)
+    rows = np.repeat(np.arange(country_years), len(ages))
+    K = 100000 * np.cumprod(np.c_[np.ones(country_years), rng.uniform(0.95, 1, (country_years, 110))], axis=1).ravel()
+    hmd_df = pd.DataFrame({
+        "ISO3": iso3.iloc[pop[rows]].array, "Year": year[rows], "Age": np.tile(ages, country_years),
+        "K": K, "ex": rng.uniform(60, 85, len(rows)),
+        "ISO3_suffix": suffix.iloc[pop[rows]].array, "lx": K / 100000,
+    })
+
+    # HFD: ages 12..55 for 90% of the country-years
+    kept = np.flatnonzero(rng.uniform(size=country_years) < 0.9)
+    ages = np.arange(12, 56, dtype=np.int16)
+    rows = np.repeat(kept, len(ages))
+    hfd_df = pd.DataFrame({
+        "ISO3": iso3.iloc[pop[rows]].array, "Year": year[rows], "Age": np.tile(ages, len(kept)),
+        "mx": rng.uniform(0, 0.1, len(rows)), "ISO3_suffix": suffix.iloc[pop[rows]].array,
+    })
+    return hmd_df, hfd_df
+
+
+def population_codes(n: int) -> list:
+    # HMD/HFD-like codes, a three letter ISO3 with every other one followed by a suffix (AAA, AAATNP, AAB, ...)
+    letters = string.ascii_uppercase
+    iso3 = ["".join(letters[(i // 26 ** k) % 26] for k in (2, 1, 0)) for i in range(n // 2 + 1)]
+    return [iso3[i // 2] + ("TNP" if i % 2 else "") for i in range(n)]
+
+
+def write_hmd(path, codes, rng, chunk: int = 50):
+    # fltper_1x1.txt layout: title, blank line, header, one row per (population, year, age), written in blocks of populations
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write("Synthetic female life tables (period 1x1)\n\nPopName Year Age mx qx ax lx dx Lx Tx ex\n")
+        for start in range(0, len(codes), chunk):
+            block = codes[start:start + chunk]
+            groups = len(block) * len(YEARS)
+            lx = 100000 * np.cumprod(np.c_[np.ones(groups), rng.uniform(0.95, 1, (groups, len(HMD_AGES) - 1))], axis=1)
+            lx = lx.ravel().round().astype(np.int64)
+            qx = rng.uniform(0, 0.05, len(lx))
+            pd.DataFrame({
+                "PopName": np.repeat(block, len(YEARS) * len(HMD_AGES)),
+                "Year": np.tile(np.repeat(YEARS, len(HMD_AGES)), len(block)),
+                "Age": np.tile(HMD_AGES, groups),
+                "mx": qx, "qx": qx, "ax": 0.5, "lx": lx, "dx": lx, "Lx": lx, "Tx": lx,
+                "ex": rng.uniform(0, 85, len(lx)),
+            }).to_csv(f, sep=" ", header=False, index=False, float_format="%.5f")
+
+
+def write_hfd(path, codes, rng, chunk: int = 50):
+    # asfrRR.txt layout, ages 12- to 55+ for the years from HFD_FIRST_YEAR
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    years = YEARS[YEARS >= HFD_FIRST_YEAR]
+    with open(path, "w") as f:
+        f.write("Synthetic age-specific fertility rates\n\nCode Year Age ASFR\n")
+        for start in range(0, len(codes), chunk):
+            block = codes[start:start + chunk]
+            rows = len(block) * len(years) * len(HFD_AGES)
+            pd.DataFrame({
+                "Code": np.repeat(block, len(years) * len(HFD_AGES)),
+                "Year": np.tile(np.repeat(years, len(HFD_AGES)), len(block)),
+                "Age": np.tile(HFD_AGES, len(block) * len(years)),
+                "ASFR": rng.uniform(0, 0.1, rows),
+            }).to_csv(f, sep=" ", header=False, index=False, float_format="%.5f")
+
+
+def write_wblg(path, iso3s, rng):
+    # "Country Analytical History" sheet: title row, blank rows, the year row, blank rows, then one row per economy
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    years = list(range(1987, 2024))
+    width = len(years) + 2
+    rows = [[None] * width] * 4 + [[None, "Data for calendar year :"] + years] + [[None] * width] * 5
+    rows += [[c, f"{c} name"] + list(rng.choice(["L", "LM", "UM", "H", ".."], len(years))) for c in iso3s[:WBLG_ROWS]]
+    rows += [[None] * width] * (240 - len(rows))
+    pd.DataFrame(rows, columns=["World Bank"] + [None] * (width - 1)).to_excel(
+        path, sheet_name="Country Analytical History", index=False)
+
+
+def write_hg(folder, rng):
+    # Age, lx, mx tables in the HG folder hg.py discovers its populations in, as .xlsx workbooks and .csv
+    os.makedirs(folder, exist_ok=True)
+    ages = np.arange(0, 86)
+    for name in HG_FILES:
+        lx = np.cumprod(np.r_[1.0, rng.uniform(0.9, 1, len(ages) - 1)])
+        mx = np.where((ages >= 15) & (ages < 50), rng.uniform(0, 0.15, len(ages)), 0)
+        df = pd.DataFrame({"Age": ages, "lx": lx, "mx": mx})
+        if name.endswith(".xlsx"): df.to_excel(os.path.join(folder, name), index=False)
+        else: df.to_csv(os.path.join(folder, name), index=False)
+
+
+def write_raw(root, scale: float, seed: int = 0) -> dict:
+    '''
+    write HMD, HFD, WBLG and HG shaped raw files under root/data/raw, with scale times
+    the real country-year count (1 to 100), to the paths the loaders read
+    '''
+    from src.python import hmd, hfd, hg, income_status
+
+    rng = np.random.default_rng(seed)
+    codes = population_codes(max(1, int(np.ceil(scale * REAL_COUNTRY_YEARS / len(YEARS)))))
+    start = time.perf_counter()
+
+    write_hmd(os.path.join(root, hmd.download_path, "fltper_1x1", "fltper_1x1.txt"), codes, rng)
+    write_hfd(os.path.join(root, hfd.download_path, "asfrRR.txt"), codes, rng)
+    write_wblg(os.path.join(root, income_status.download_path), list(dict.fromkeys(c[:3] for c in codes)), rng)
+    write_hg(os.path.join(root, hg.HG_DATA_DIR), rng)
+
+    info = {"populations": len(codes), "country_years": len(codes) * len(YEARS)}
+    log.log(f"wrote synthetic raw data at scale {scale:g}: {info['country_years']} country-years in {time.perf_counter() - start:.1f}s")
+    return info
+
+
+def merge_hmd_hfd_df_merges(hmd_df: pd.DataFrame, hfd_df: pd.DataFrame) -> pd.DataFrame:
+    '''
+    the earlier merge-based merge_hmd_hfd_df (inner merges, cross join grid, two left merges),
+    kept to check and time the index-based version against
+    '''
+    hmd_df, hfd_df = schema.align_categories(hmd_df, hfd_df)
+    keys = ["ISO3", "ISO3_suffix", "Year"]
+    common_df = pd.merge(hmd_df[keys].drop_duplicates(), hfd_df[keys].drop_duplicates(), on=keys, how="inner")
+
+    hmd_df = hmd_df.merge(common_df, on=keys, how="inner")
+    hfd_df = hfd_df.merge(common_df, on=keys, how="inner")
+    hmd_df = hmd_df[hmd_df["Age"].between(SETTINGS["min_age"], SETTINGS["max_age"])]
+
+    ages = pd.DataFrame({"Age": np.arange(SETTINGS["min_age"], SETTINGS["max_age"] + 1, dtype=np.int16)})
+    grid = common_df.assign(_k=1).merge(ages.assign(_k=1), on="_k").drop(columns="_k")
+    df = grid.merge(hmd_df, on=schema.KEYS, how="left")
+    df = df.merge(hfd_df, on=schema.KEYS, how="left")
+    return schema.apply(df[[*schema.KEYS, *[c for c in df.columns if c not in schema.KEYS]]])
+
+
+def timed(f, *args, repeat: int = 3):
+    # best wall time of repeat calls, and the last result
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = f(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def peak_mb(f, *args) -> float:
+    # peak memory allocated during one call, in MB
+    tracemalloc.start()
+    try:
+        f(*args)
+        return tracemalloc.get_traced_memory()[1] / 1e6
+    finally:
+        tracemalloc.stop()
+
+
+def bench_merge(sizes=(100, 1000, 5000, 20000)):
+    '''
+    time and peak memory of merge_hmd_hfd_df against the earlier merge-based version,
+    for a growing number of country-years
+    '''
+    from src.python.life_table import merge_hmd_hfd_df
+
+    log.log("Benchmarking merge_hmd_hfd_df (index reindex vs. hash merges)...")
+    log.log(f"  {'country-years':>13} {'rows':>10} {'merges (s)':>11} {'reindex (s)':>12} {'speedup':>8} {'merges (MB)':>12} {'reindex (MB)':>13}")
+    for n in sizes:
+        hmd_df, hfd_df = synthetic_tables(n)
+        old, _ = timed(merge_hmd_hfd_df_merges, hmd_df, hfd_df)
+        new, df = timed(merge_hmd_hfd_df, hmd_df, hfd_df)
+        old_mb, new_mb = peak_mb(merge_hmd_hfd_df_merges, hmd_df, hfd_df), peak_mb(merge_hmd_hfd_df, hmd_df, hfd_df)
+        log.log(f"  {n:>13} {len(df):>10} {old:>11.3f} {new:>12.3f} {old / new:>7.1f}x {old_mb:>12.0f} {new_mb:>13.0f}")
+
+
+def measure(records: list, stage: str, f, memory: bool = True):
+    '''
+    call f once timed and (if memory) once more under tracemalloc for its peak allocation,
+    append a record of the stage to records and return f's result
+    '''
+    wall, cpu = time.perf_counter(), time.process_time()
+    result = f()
+    record = {
+        "stage": stage,
+        "seconds": round(time.perf_counter() - wall, 4),
+        "cpu_seconds": round(time.process_time() - cpu, 4),
+        "peak_mb": round(peak_mb(f), 2) if memory else None,
+    }
+    if isinstance(result, pd.DataFrame):
+        record["rows"] = len(result)
+        record["mb"] = round(result.memory_usage(deep=True).sum() / 1e6, 2)
+    elif isinstance(result, str) and os.path.isfile(result):
+        record["mb"] = round(os.path.getsize(result) / 1e6, 2) # written file
+
+    records.append(record)
+    log.log(f"benchmark {stage}: {record['seconds']:.3f}s" + (f", peak {record['peak_mb']:.1f} MB" if memory else ""))
+    return result
+
+
+def run_suite(scale: float, r: bool = False, memory: bool = True, workers=None, seed: int = 0) -> list:
+    '''
+    write synthetic raw data at scale into a temporary folder and run every stage on it in order:
+    load, format, merge, CSV writes, derivatives, country table and Keyfitz, optionally the R scripts
+    '''
+    import main
+    from src.python import cache, hmd, hfd, hg, income_status, life_table, country_table, life_table_derivatives
+    from src.python.helper import RunContext, get_run_context, set_run_context
+
+    repo = os.getcwd()
+    SETTINGS.values # read settings.json5 before leaving the repository folder
+    records = []
+
+    with tempfile.TemporaryDirectory() as root:
+        info = write_raw(root, scale, seed)
+
+        context, cached = get_run_context(), cache.enabled
+        os.chdir(root)
+        set_run_context(RunContext(os.path.join("data", "processed", "benchmark")))
+        cache.set_enabled(False) # time the parsers, not the cache
+        try:
+            def stage(name, f, memory=memory): return measure(records, name, f, memory)
+
+            raw_hmd = stage("load_hmd", lambda: hmd.load_hmd(hmd.download_path))
+            hmd_df = stage("format_hmd", lambda: hmd.format_hmd(raw_hmd.copy()))
+            raw_hfd = stage("load_hfd", lambda: hfd.load_hfd(hfd.download_path))
+            hfd_df = stage("format_hfd", lambda: hfd.format_hfd(raw_hfd.copy()))
+            hg_df = stage("hg", hg.generate_hg_df)
+            raw_income = stage("load_income_status", lambda: income_status.load_income_status(income_status.download_path))
+            income_df = stage("format_income_status", lambda: income_status.format_income_status(raw_income.copy()))
+
+            life_df = stage("merge", lambda: life_table.combine_life_table(hmd_df, hfd_df, hg_df.copy()))
+            life_table_path = stage("write_life_table", lambda: life_table.write_life_table(life_df))
+            stage("derivatives", lambda: life_table_derivatives.calculate_derivatives(life_df))
+            if r: stage("R:life_table_derivatives", lambda: main.run_r(os.path.join(repo, main.life_table_derivatives_R), life_table_path), memory=False)
+
+            # the country table is built from the merged table in memory, as in the pipeline
+            formatted_df = stage("country_table", lambda: country_table.format_country_table(income_df, life_df))
+            country_df = stage("keyfitz", lambda: country_table.add_keyfitz_H(formatted_df, life_df, workers)[0]) # the per-age table comes from the same pass
+            country_table_path = stage("write_country_table", lambda: country_table.write_country_table(country_df))
+
+            # the R scripts rewrite country_table.csv in place, so they only run once and their memory is not traced
+            if r:
+                for script in (main.generation_time_R, main.ne_felsenstein_R, main.mx_shape_metrics_R, main.prr_calculation_R):
+                    name = os.path.splitext(os.path.basename(script))[0]
+                    stage(f"R:{name}", lambda: main.run_r(os.path.join(repo, script), life_table_path, country_table_path), memory=False)
+        finally:
+            log.flush() # the run folder is relative to root
+            os.chdir(repo)
+            set_run_context(context)
+            cache.set_enabled(cached)
+
+    for record in records: record.update(scale=scale, **info)
+    return records
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def write_results(records: list, path=None) -> str:
+    '''
+    write the records with the commit, library versions and settings to data/benchmarks (or path) as JSON
+    '''
+    if path is None:
+        path = os.path.join(BENCHMARK_FOLDER, f"benchmark-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    content = {
+        "created": get_datetimestamp(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "settings": dict(SETTINGS),
+        "results": records,
+    }
+    with open(path, "w") as f:
+        json.dump(content, f, indent=2)
+
+    log.log(f"wrote benchmark results: {path}")
+    return path
+
+
+def compare(base_path, path, tolerance: float = 0.25) -> list:
+    '''
+    stages (at the same scale) that got slower or use more memory than in base_path by more than tolerance,
+    small absolute changes (50 ms, 1 MB) are ignored as noise
+    '''
+    with open(base_path) as f: base = {(r["stage"], r["scale"]): r for r in json.load(f)["results"]}
+    with open(path) as f: results = json.load(f)["results"]
+
+    regressions = []
+    for r in results:
+        old = base.get((r["stage"], r["scale"]))
+        if old is None: continue
+        for metric, floor in (("seconds", 0.05), ("peak_mb", 1.0)):
+            a, b = old.get(metric), r.get(metric)
+            if a is None or b is None: continue
+            if b > a * (1 + tolerance) and b - a > floor:
+                regressions.append({"stage": r["stage"], "scale": r["scale"], "metric": metric, "base": a, "new": b})
+                log.warn(f"regression: {r['stage']} at scale {r['scale']:g}, {metric} {a:g} -> {b:g}")
+
+    log.log(f"compared with {base_path}: {len(regressions)} regression(s)")
+    return regressions
+
+
+def test_merge_parity(country_years: int = 500):
+    '''
+    the index-based merge_hmd_hfd_df gives the same table as the merge-based version
+    '''
+    from src.python.life_table import merge_hmd_hfd_df
+
+    log.log("Testing merge_hmd_hfd_df against the merge-based version...")
+    hmd_df, hfd_df = synthetic_tables(country_years)
+    expected = merge_hmd_hfd_df_merges(hmd_df, hfd_df)
+    result = merge_hmd_hfd_df(hmd_df, hfd_df)
+
+    same = result.columns.equals(expected.columns) and result.dtypes.equals(expected.dtypes) and result.equals(expected)
+    log.log(f"  {len(result)} rows, identical: {same}")
+    return same
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark every pipeline stage on synthetic data")
+    parser.add_argument("--scales", type=float, nargs="+", default=[1], help="multiples of the real country-year count, e.g. 1 10 100")
+    parser.add_argument("--r", action="store_true", help="also time the R scripts (needs Rscript and the R packages)")
+    parser.add_argument("--no-memory", action="store_true", help="skip the traced second run of each stage")
+    parser.add_argument("--workers", type=int, default=None, help="processes used for H_N")
+    parser.add_argument("--out", default=None, help="result file (default data/benchmarks/benchmark-<time>.json)")
+    parser.add_argument("--compare", default=None, help="earlier result file, exits with 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown or memory growth (0.25 = 25%%)")
+    parser.add_argument("--merge", action="store_true", help="only check and time merge_hmd_hfd_df against the merge-based version")
+    args = parser.parse_args()
+
+    if args.merge:
+        test_merge_parity()
+        bench_merge()
+        sys.exit()
+
+    records = [r for scale in args.scales for r in run_suite(scale, args.r, not args.no_memory, args.workers)]
+    path = write_results(records, args.out)
+    if args.compare and compare(args.compare, path, args.tolerance): sys.exit(1)
@@ -0,0 +1,157 @@
+import os, json, hashlib
+import pandas as pd
+from src.python.helper import CACHE_FOLDER, SETTINGS
+from src.python import log, schema
+
+pa = feather = None # pyarrow is optional and only imported on first use
+
+
+CACHE_VERSION = 3 # bump when a loader changes what it returns
+INDEX_FILE = os.path.join(CACHE_FOLDER, "index.json")
+
+enabled = True
+
+
+def set_enabled(value: bool):
+    global enabled
+    enabled = value
+
+
+def import_pyarrow() -> bool:
+    # without pyarrow every run re-parses the raw files
+    global pa, feather
+    if pa is None:
+        try:
+            import pyarrow as pa
+            import pyarrow.feather as feather
+        except ImportError:
+            return False
+    return True
+
+
+def hash_file(path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def load_index() -> dict:
+    try:
+        with open(INDEX_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_index(index: dict):
+    os.makedirs(CACHE_FOLDER, exist_ok=True)
+    tmp = INDEX_FILE + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp, INDEX_FILE)
+
+
+def fingerprint(path) -> str:
+    '''
+    content hash of a file, only re-hashed when its path, size or mtime changes
+    '''
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    index = load_index()
+
+    entry = index.get(path)
+    if entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+        return entry["sha256"]
+
+    digest = hash_file(path)
+    index[path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest}
+    save_index(index)
+    return digest
+
+
+def evict(max_bytes: int):
+    '''
+    remove least recently used cache files until the cache fits in max_bytes
+    '''
+    files = [
+        os.path.join(CACHE_FOLDER, f) for f in os.listdir(CACHE_FOLDER) if f.endswith(".feather")
+    ]
+    files.sort(key=os.path.getmtime) # hits touch the file, so oldest mtime = least recently used
+
+    total = sum(os.path.getsize(f) for f in files)
+    for f in files:
+        if total <= max_bytes: break
+        total -= os.path.getsize(f)
+        os.remove(f)
+        log.log(f"evicted from cache: {os.path.basename(f)}")
+
+
+def cache_file(name: str, path, subset: str = "") -> str:
+    key = hashlib.sha256(f"{name}:{CACHE_VERSION}:{fingerprint(path)}:{subset}".encode()).hexdigest()
+    return os.path.join(CACHE_FOLDER, f"{name}-{key[:16]}.feather")
+
+
+def read_rows(cache_path, rows) -> pd.DataFrame:
+    # only the rows kept by rows (a selection.RowFilter) become a data frame, found from its key columns
+    table = feather.read_table(cache_path, memory_map=True)
+    keep = rows.mask(table.select(rows.columns).to_pandas())
+    return schema.drop_unused_categories(table.filter(pa.array(keep)).to_pandas())
+
+
+def load(name: str, path, loader, rows=None) -> pd.DataFrame:
+    '''
+    return loader(path), reusing the frame stored for the same file content if there is one,
+    with rows (a selection.RowFilter) only the selected rows: taken from the cached full frame when there is one,
+    otherwise loader(path, rows) parses just them and is cached for this subset
+    '''
+    parse = loader if rows is None else lambda p: loader(p, rows)
+    if not enabled or not import_pyarrow():
+        return parse(path)
+
+    if rows is not None:
+        full = cache_file(name, path)
+        if os.path.exists(full):
+            os.utime(full)
+            df = read_rows(full, rows)
+            log.log(f"loaded {len(df)} selected {name} rows from cache: {full}")
+            return df
+
+    subset = "" if rows is None else rows.key
+    df = lookup(name, path, subset)
+    if df is not None: return df
+
+    df = parse(path)
+    store(name, path, df, subset)
+    return df
+
+
+def lookup(name: str, path, subset: str = ""):
+    # the cached frame of path, None when there is none (or the cache is off)
+    if not enabled or not import_pyarrow(): return None
+    cache_path = cache_file(name, path, subset)
+    if not os.path.exists(cache_path): return None
+
+    os.utime(cache_path) # mark as recently used
+    df = feather.read_table(cache_path, memory_map=True).to_pandas()
+    log.log(f"loaded {name} from cache: {cache_path}")
+    return df
+
+
+def store(name: str, path, df: pd.DataFrame, subset: str = ""):
+    # cache df as the parsed frame of path, e.g. after parsing several files in worker processes
+    if not enabled or not import_pyarrow(): return
+    cache_path = cache_file(name, path, subset)
+
+    tmp = cache_path + ".tmp"
+    try:
+        feather.write_feather(pa.Table.from_pandas(df), tmp, compression="uncompressed") # uncompressed so it can be memory-mapped
+    except (pa.ArrowException, TypeError, ValueError) as e:
+        log.warn(f"could not cache {name}, columns are not typed: {e}")
+        if os.path.exists(tmp): os.remove(tmp)
+        return
+    os.replace(tmp, cache_path)
+    log.log(f"cached {name}: {cache_path}")
+
+    evict(SETTINGS.get("cache_max_mb", 2048) * 1024 * 1024)
@@ -1,68 +1,91 @@
 import os
 import pandas as pd
-from src.python import income_status, log
-from src.python.helper import SETTINGS, OUT_PATH
-from src.python.Keyfitz_entropy import calculate_H_for_dataset
+from src.python import income_status, log, schema, profiler, table_io
+from src.python.helper import SETTINGS, out_path
+from src.python.Keyfitz_entropy import calculate_H_for_dataset, SURVIVORSHIP_METRICS
 
 
-def load_life_table(life_table_path): return pd.read_csv(life_table_path, engine="python")
+COUNTRY_YEAR = ["ISO3", "ISO3_suffix", "Year"]
+
+
+# countries: ISO3 codes to read, only their partitions when the table is partitioned (all by default)
+def load_life_table(life_table_path, countries=None): return table_io.read_table(life_table_path, schema.read_csv, countries) # a CSV is parsed straight into the schema dtypes
+
+
+def load_country_table(country_table_path, countries=None):
+    df = table_io.read_table(country_table_path, countries=countries)
+    df["ISO3_suffix"] = schema.fill_category(df["ISO3_suffix"], "") # written as empty, keep it as empty string to match H_N keys
+    return df
+
+
+def country_years(life_table_df: pd.DataFrame) -> pd.DataFrame:
+    # unique (ISO3, ISO3_suffix, Year) of the life table, found on the key codes without copying any value column
+    keys = pd.MultiIndex.from_arrays([life_table_df[c] for c in COUNTRY_YEAR]).unique()
+    return keys.to_frame(index=False)
 
 
 def format_country_table(income_status_df: pd.DataFrame, life_table_df: pd.DataFrame):
     '''
     format the income status table for WBLG so that it only filters for countries also in the life table
     '''
-    inc = income_status_df.copy()
-    life = life_table_df.copy()
+    idx = country_years(life_table_df)
 
-    # make sure ISO3 all upper case
-    inc["ISO3"] = inc["ISO3"].astype(str).str.upper().str.strip()
-    life["ISO3"] = life["ISO3"].astype(str).str.upper().str.strip()
-
-    # index of unique (iso3, iso3_suffix, year)
-    idx: pd.DataFrame = (
-        life[["ISO3", "ISO3_suffix", "Year"]]
-        .drop_duplicates()
-    )
+    # make sure ISO3 all upper case, done on the distinct codes (the income table is only selected, not copied whole)
+    idx["ISO3"] = schema.map_categories(idx["ISO3"], lambda c: c.str.upper().str.strip())
+    inc = income_status_df[["ISO3", "Year", "IS"]].assign(ISO3=lambda d: schema.map_categories(d["ISO3"], lambda c: c.str.upper().str.strip()))
+    idx, inc = schema.align_categories(idx, inc)
 
     # merge income (iso3, year) only
-    out = idx.merge(
-        inc[["ISO3", "Year", "IS"]],
-        on=["ISO3", "Year"],
-        how="left"
-    ).sort_values(["ISO3", "ISO3_suffix", "Year"])
+    out = idx.merge(inc, on=["ISO3", "Year"], how="left").sort_values(COUNTRY_YEAR)
 
-    out["ISO3_suffix"] = out["ISO3_suffix"].fillna("")
+    out["ISO3_suffix"] = schema.fill_category(out["ISO3_suffix"], "")
     
     log.log("formated the country table")
     return out[["ISO3", "ISO3_suffix", "Year", "IS"]]
 
 
-def generate_country_table(life_table_path, download: bool):
-    income_status_df, path = income_status.generate_income_status_df(download)
-
-    life_table_df = load_life_table(life_table_path)
-    country_table_df = format_country_table(income_status_df, life_table_df)
-
+def add_keyfitz_H(country_table_df: pd.DataFrame, life_table_df: pd.DataFrame, workers=None):
+    '''
+    returns the country table with H_N and the other survivorship metrics, and the wide table of
+    remaining life expectancy at every age (e_0, e_1, ...) per country-year from the same pass
+    '''
     log.log("calcualting all keyfitz entropy using matricies (H_N) fr all country-years")
-    H_df = calculate_H_for_dataset(life_table_df)
-
+    H_df, ex_df = calculate_H_for_dataset(life_table_df, workers, per_age=True)
 
-
-    #merge H_N values into country table
+    #merge H_N and the other survivorship metrics of the same pass into country table
     country_table_df = country_table_df.merge(
-        H_df[['ISO3', 'ISO3_suffix', 'Year', 'H_N']],
+        H_df[['ISO3', 'ISO3_suffix', 'Year', *SURVIVORSHIP_METRICS]],
         on=["ISO3", "ISO3_suffix", "Year"],
         how="left"
     )
 
-    
-    
+    log.log(f"merged {', '.join(SURVIVORSHIP_METRICS)} values into country table")
+    return country_table_df, ex_df
 
 
+def write_country_table(country_table_df: pd.DataFrame) -> str:
+    path = os.path.join(out_path(), "country_table.csv")
+    table_io.write_table(country_table_df, path)
+    return path
 
-    log.log("merged H_N values into country table")
 
-    path = os.path.join(OUT_PATH, "country_table.csv")
-    country_table_df.to_csv(path, index=False)
+def write_remaining_life_expectancy(ex_df: pd.DataFrame) -> str:
+    path = os.path.join(out_path(), "remaining_life_expectancy.csv")
+    table_io.write_table(ex_df, path)
     return path
+
+
+@profiler.profiled()
+def generate_country_table(life_table, download: bool, workers=None):
+    '''
+    life_table is the life table data frame (e.g. from generate_life_table) or the path of a written life_table.csv
+    '''
+    if download: income_status.download_income_status()
+    income_status_df = income_status.income_status_table() # the cached long table, income_status.csv is written by its own stage
+
+    life_table_df = life_table if isinstance(life_table, pd.DataFrame) else load_life_table(life_table)
+    country_table_df = format_country_table(income_status_df, life_table_df)
+    country_table_df, ex_df = add_keyfitz_H(country_table_df, life_table_df, workers)
+
+    write_remaining_life_expectancy(ex_df)
+    return write_country_table(country_table_df)
@@ -0,0 +1,86 @@
+import os, shutil
+import pandas as pd
+from src.python import log, table_io, profiler
+from src.python.helper import out_path
+from src.python.country_table import load_life_table, load_country_table
+
+
+DASHBOARD_FOLDER = "dashboard" # in the run folder, read by ShinyPipeline.R
+METRICS = ["H_N", "e0", "e_N", "e_dagger", "V_N", "T", "Ne", "N_ratio"] # aggregated per country and per income group
+LIFE_COLUMNS = ["lx", "mx", "qx", "ex"] # life table variables the dashboard can plot
+
+
+def life_columns(life_table_df: pd.DataFrame) -> list:
+    return ["ISO3", "ISO3_suffix", "Year", "Age"] + [c for c in LIFE_COLUMNS if c in life_table_df.columns]
+
+
+def country_summary(life_table_df: pd.DataFrame, country_table_df: pd.DataFrame) -> pd.DataFrame:
+    '''
+    one row per country: the years it has life table data for, which tables it is in,
+    its latest income status and the mean, min and max of every metric
+    '''
+    life = life_table_df.groupby("ISO3", observed=True)["Year"].agg(first_year="min", last_year="max")
+    life["in_life"] = True
+
+    country = country_table_df.sort_values("Year").groupby("ISO3", observed=True)
+    columns = {"in_country": country.size() > 0}
+    if "IS" in country_table_df.columns: columns["IS"] = country["IS"].last() # latest known
+    summary = pd.DataFrame(columns)
+    metrics = [m for m in METRICS if m in country_table_df.columns]
+    if metrics:
+        stats = country[metrics].agg(["mean", "min", "max"])
+        stats.columns = [f"{m}_{stat}" for m, stat in stats.columns]
+        summary = summary.join(stats)
+
+    # plain string keys on both sides, the two tables may not share ISO3 categories
+    life.index, summary.index = life.index.astype(str), summary.index.astype(str)
+    out = life.join(summary, how="outer")
+    out[["in_life", "in_country"]] = out[["in_life", "in_country"]].fillna(False).astype(bool)
+    return out.rename_axis("ISO3").reset_index()
+
+
+def income_group_summary(country_table_df: pd.DataFrame) -> pd.DataFrame:
+    # per income group and year: number of countries and the mean and median of every metric
+    metrics = [m for m in METRICS if m in country_table_df.columns]
+    if "IS" not in country_table_df.columns: return pd.DataFrame(columns=["IS", "Year", "countries"])
+
+    grouped = country_table_df.groupby(["IS", "Year"], observed=True, sort=True)
+    out = grouped["ISO3"].nunique().rename("countries").to_frame()
+    if metrics:
+        stats = grouped[metrics].agg(["mean", "median"])
+        stats.columns = [f"{m}_{stat}" for m, stat in stats.columns]
+        out = out.join(stats)
+    return out.reset_index()
+
+
+def write_store(life_table_df: pd.DataFrame, country_table_df: pd.DataFrame, folder) -> str:
+    '''
+    write the dashboard store into folder:
+      country_years   the country table, one row per (ISO3, ISO3_suffix, Year)
+      year_life       life table rows at age 0, for Year against a life table variable (as the dashboard without a store)
+      countries       country_summary
+      income_groups   income_group_summary
+      detail/<ISO3>   the life table of one country, read by the dashboard when that country is plotted
+    '''
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(os.path.join(folder, "detail"))
+
+    life = life_table_df[life_columns(life_table_df)]
+    table_io.write_table(country_table_df, os.path.join(folder, "country_years.csv"))
+    table_io.write_table(life[life["Age"] == 0], os.path.join(folder, "year_life.csv"))
+    table_io.write_table(country_summary(life, country_table_df), os.path.join(folder, "countries.csv"))
+    table_io.write_table(income_group_summary(country_table_df), os.path.join(folder, "income_groups.csv"))
+
+    for iso3, rows in life.groupby("ISO3", observed=True, sort=True):
+        table_io.write_table(rows.reset_index(drop=True), os.path.join(folder, "detail", f"{iso3}.csv"))
+
+    log.log(f"wrote the dashboard store: {folder}")
+    return folder
+
+
+@profiler.profiled()
+def generate_dashboard_store(life_table, country_table) -> str:
+    # life_table and country_table are the final tables (data frames or paths), written after the R scripts
+    life_table_df = life_table if isinstance(life_table, pd.DataFrame) else load_life_table(life_table)
+    country_table_df = country_table if isinstance(country_table, pd.DataFrame) else load_country_table(country_table)
+    return write_store(life_table_df, country_table_df, os.path.join(out_path(), DASHBOARD_FOLDER))
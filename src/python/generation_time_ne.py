@@ -0,0 +1,214 @@
+import os, shutil, subprocess, tempfile
+import numpy as np
+import pandas as pd
+from src.python import log, profiler, schema
+from src.python.country_table import COUNTRY_YEAR, country_years, load_life_table, load_country_table, write_country_table
+
+
+GENERATION_TIME_R = "src/R/generation_time.R"
+NE_FELSENSTEIN_R = "src/R/ne_felsenstein.R"
+# expected T and Ne for the synthetic life table, transcribed from the per-group code of generation_time.R and
+# ne_felsenstein.R rather than written by R, write_T_Ne_fixture replaces it with the output of the R scripts
+T_NE_FIXTURE = "tests/fixtures/generation_time_ne_reference.csv"
+
+N1 = 1000 # same constant as ne_felsenstein.R
+T_COLUMNS = ["T"]
+NE_COLUMNS = ["N_sum", "Ne", "N_ratio"]
+
+
+def stack_columns(life_table_df: pd.DataFrame, columns: list):
+    '''
+    dense (group x age) arrays of columns, one row per (ISO3, ISO3_suffix, Year) in order of appearance,
+    within a group the rows keep their order (the next row is the next age, as in the R scripts),
+    padded with NaN after the last row of a group
+    returns keys (ISO3, ISO3_suffix "" when missing, Year), {column: array} and the rows per group
+    '''
+    missing = [c for c in [*COUNTRY_YEAR, *columns] if c not in life_table_df.columns]
+    if missing: log.error(f"missing required columns: {', '.join(missing)}")
+
+    grouped = life_table_df.groupby(COUNTRY_YEAR, sort=False, dropna=False, observed=True)
+    group = grouped.ngroup().to_numpy()
+    position = grouped.cumcount().to_numpy()
+
+    keys = life_table_df.loc[~pd.Series(group).duplicated().to_numpy(), COUNTRY_YEAR].reset_index(drop=True)
+    keys["ISO3_suffix"] = schema.fill_category(keys["ISO3_suffix"], "")
+    lengths = np.bincount(group, minlength=len(keys))
+
+    arrays = {}
+    for c in columns:
+        dense = np.full((len(keys), lengths.max(initial=0)), np.nan, dtype=np.float64)
+        dense[group, position] = pd.to_numeric(life_table_df[c], errors="coerce").to_numpy(dtype=np.float64)
+        arrays[c] = dense
+    return keys, arrays, lengths
+
+
+def calculate_generation_time(life_table_df: pd.DataFrame) -> pd.DataFrame:
+    '''
+    T = sum(Age * lx * mx) / sum(lx * mx) for every country-year, missing terms are skipped as in generation_time.R
+    '''
+    keys, a, _ = stack_columns(life_table_df, ["Age", "lx", "mx"])
+
+    lxmx = a["lx"] * a["mx"]
+    numerator = np.nansum(a["Age"] * lxmx, axis=1)
+    denominator = np.nansum(lxmx, axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        keys["T"] = np.where(denominator != 0, numerator / denominator, np.nan)
+    return keys
+
+
+def calculate_ne(life_table_df: pd.DataFrame, T: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Felsenstein Ne = N1 * T / (1 + sum(lx * sx * dx * vx[x+1])) for every country-year, as ne_felsenstein.R:
+    the sum is over every age but the last one where the four values are finite,
+    N_ratio = Ne / N_sum, all three are missing for country-years without a T
+    T has the country-year keys and a T column (the country table)
+    '''
+    keys, a, _ = stack_columns(life_table_df, ["N", "lx", "sx", "dx", "vx"])
+
+    # T of each life table group, missing when the country table has no row for it
+    keys, T = schema.align_categories(keys, T[[*COUNTRY_YEAR, "T"]].assign(ISO3_suffix=lambda d: schema.fill_category(d["ISO3_suffix"], "")))
+    T_val = keys.merge(T, on=COUNTRY_YEAR, how="left")["T"].to_numpy(dtype=np.float64)
+
+    # age x and the next age of the same group, the padding after a group is NaN so it never counts
+    terms = a["lx"][:, :-1] * a["sx"][:, :-1] * a["dx"][:, :-1] * a["vx"][:, 1:]
+    denominator = np.where(np.isfinite(terms), terms, 0).sum(axis=1) + 1
+
+    N_sum = np.nansum(a["N"], axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        Ne = N1 * T_val / denominator
+        N_ratio = Ne / N_sum
+
+    valid = ~np.isnan(T_val)
+    keys["N_sum"] = np.where(valid, N_sum, np.nan)
+    keys["Ne"] = np.where(valid, Ne, np.nan)
+    keys["N_ratio"] = np.where(valid, N_ratio, np.nan)
+    return keys
+
+
+def merge_country_years(country_table_df: pd.DataFrame, results: pd.DataFrame, how: str) -> pd.DataFrame:
+    # merge like the R scripts: on the country-year, replacing earlier values, sorted by ISO3, ISO3_suffix, Year
+    columns = [c for c in results.columns if c not in COUNTRY_YEAR]
+    country = country_table_df.drop(columns=columns, errors="ignore")
+    country, results = schema.align_categories(country, results)
+    out = country.merge(results, on=COUNTRY_YEAR, how=how)
+    by_text = lambda s: s.astype(str) if isinstance(s.dtype, pd.CategoricalDtype) else s
+    return out.sort_values(COUNTRY_YEAR, key=by_text, kind="stable").reset_index(drop=True)
+
+
+def read_tables(life_table, country_table):
+    # data frames or the paths of the written tables
+    life_table_df = life_table if isinstance(life_table, pd.DataFrame) else load_life_table(life_table)
+    country_table_df = country_table if isinstance(country_table, pd.DataFrame) else load_country_table(country_table)
+    return life_table_df, country_table_df
+
+
+def add_generation_time(country_table_df: pd.DataFrame, life_table_df: pd.DataFrame) -> pd.DataFrame:
+    T_df = calculate_generation_time(life_table_df)
+    log.log(f"calculated T for {len(T_df)} country-years")
+    return merge_country_years(country_table_df, T_df, "left")
+
+
+def add_ne(country_table_df: pd.DataFrame, life_table_df: pd.DataFrame) -> pd.DataFrame:
+    Ne_df = calculate_ne(life_table_df, country_table_df)
+    log.log(f"calculated Ne for {len(Ne_df)} country-years")
+    return merge_country_years(country_table_df, Ne_df, "outer") # ne_felsenstein.R keeps life table groups missing from the country table
+
+
+@profiler.profiled()
+def generate_generation_time(life_table, country_table) -> pd.DataFrame:
+    # in-process generation_time.R, life_table is read after the derivatives, country_table after keyfitz
+    life_table_df, country_table_df = read_tables(life_table, country_table)
+    df = add_generation_time(country_table_df, life_table_df)
+    write_country_table(df)
+    return df
+
+
+@profiler.profiled()
+def generate_ne(life_table, country_table) -> pd.DataFrame:
+    # in-process ne_felsenstein.R, country_table has T
+    life_table_df, country_table_df = read_tables(life_table, country_table)
+    df = add_ne(country_table_df, life_table_df)
+    write_country_table(df)
+    return df
+
+
+def parity_tables(life_table_path=None):
+    # life table with derivatives and the country table the parity test starts from
+    from src.python.life_table_derivatives import calculate_derivatives, synthetic_life_table
+
+    if life_table_path is not None:
+        life = load_life_table(life_table_path)
+    else:
+        life = calculate_derivatives(schema.apply(synthetic_life_table())) # the single row group has no T
+
+    # country table without the last country-year, ne_felsenstein.R adds it back
+    country = country_years(life).iloc[:-1].assign(ISO3_suffix=lambda d: schema.fill_category(d["ISO3_suffix"], ""))
+    return life, country
+
+
+def run_T_Ne_R(life: pd.DataFrame, country: pd.DataFrame):
+    # generation_time.R then ne_felsenstein.R on the tables in a temporary folder, the country table they write or None when one fails
+    with tempfile.TemporaryDirectory() as tmp:
+        life_path, country_path = os.path.join(tmp, "life_table.csv"), os.path.join(tmp, "country_table.csv")
+        life.to_csv(life_path, index=False)
+        country.to_csv(country_path, index=False)
+        for script in (GENERATION_TIME_R, NE_FELSENSTEIN_R):
+            res = subprocess.run(["Rscript", script, life_path, country_path], capture_output=True, text=True)
+            if res.returncode != 0:
+                log.warn(f"{os.path.basename(script)} failed: {res.stderr.strip()}")
+                return None
+        return read_T_Ne(country_path)
+
+
+def read_T_Ne(path) -> pd.DataFrame: return pd.read_csv(path, keep_default_na=False, na_values=["", "NA"])
+
+
+def write_T_Ne_fixture():
+    '''
+    rewrite T_NE_FIXTURE from generation_time.R and ne_felsenstein.R on the synthetic life table,
+    run this (needs Rscript) after changing either R script or synthetic_life_table
+    '''
+    expected = run_T_Ne_R(*parity_tables())
+    if expected is None: log.error("could not write the T and Ne fixture")
+    expected[[*COUNTRY_YEAR, *T_COLUMNS, *NE_COLUMNS]].to_csv(T_NE_FIXTURE, index=False, float_format="%.15g")
+    log.log(f"wrote {T_NE_FIXTURE}")
+
+
+def compare_T_Ne(actual: pd.DataFrame, expected: pd.DataFrame, source: str) -> bool:
+    ok = len(actual) == len(expected) and (actual["Year"].to_numpy() == expected["Year"].to_numpy()).all()
+    for c in T_COLUMNS + NE_COLUMNS:
+        same = ok and np.allclose(actual[c].to_numpy(dtype=np.float64), expected[c].to_numpy(dtype=np.float64), rtol=1e-9, equal_nan=True)
+        if not same: log.warn(f"  {c} differs between {source} and python")
+        ok = ok and same
+    return ok
+
+
+def test_T_Ne_parity(life_table_path=None):
+    '''
+    compare the python T and Ne with the output of generation_time.R and ne_felsenstein.R
+    without a path: on the synthetic life table, against the reference table T_NE_FIXTURE, and against a live run of the R scripts when Rscript is on the PATH
+    with a path: on that life table, against a live run of the R scripts only (needs Rscript)
+    '''
+    log.log("Testing python T and Ne against generation_time.R and ne_felsenstein.R...")
+
+    life, country = parity_tables(life_table_path)
+    actual = add_ne(add_generation_time(country, life), life)
+
+    ok = True
+    if life_table_path is None:
+        ok = compare_T_Ne(actual, read_T_Ne(T_NE_FIXTURE), "the reference table")
+        log.log(f"  python and the reference table agree: {ok}")
+
+    if shutil.which("Rscript") is None:
+        log.warn("Rscript not found, skipping the live R comparison")
+        return ok if life_table_path is None else None
+
+    expected = run_T_Ne_R(life, country)
+    if expected is None: return False
+    same = compare_T_Ne(actual, expected, "R")
+    log.log(f"  python and R T and Ne agree: {same}")
+    return ok and same
+
+
+if __name__ == "__main__":
+    test_T_Ne_parity()
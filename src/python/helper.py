@@ -1,15 +1,12 @@
 import os, json5
+from collections.abc import MutableMapping
 from datetime import datetime
-from dotenv import load_dotenv
-
-load_dotenv()
-EMAIL = os.environ.get("EMAIL")
-PASSWORD = os.environ.get("PASSWORD")
 
 SETTINGS_FILE = "settings.json5"
 
 DOWNLOAD_FOLDER = "data/raw"
 OUTPUT_FOLDER = "data/processed"
+CACHE_FOLDER = "data/cache"
 
 R_PATH = "src/R"
 
@@ -19,18 +16,86 @@ def get_datetimestamp(): return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 def get_timestamp(): return datetime.now().strftime("%H:%M:%S")
 
 
-# initiate settings as global variable
-with open(SETTINGS_FILE, "r") as f:
-    SETTINGS = json5.load(f)
+def drop_edge_rows(df, keys, head: int = 0, tail: int = 0):
+    '''
+    drop the first head and last tail rows of every group (e.g. the open 12-, 55+ and 110+ ages),
+    built as one mask from each row's position counted from both ends of its group
+    '''
+    grouped = df.groupby(keys, sort=False, dropna=False, observed=True)
+    from_start = grouped.cumcount().to_numpy()
+    from_end = grouped.cumcount(ascending=False).to_numpy()
+    return df[(from_start >= head) & (from_end >= tail)]
+
+
+class Settings(MutableMapping):
+    '''
+    contents of settings.json5, only read the first time a value is needed
+    '''
+    def __init__(self, path=SETTINGS_FILE):
+        self.path = path
+        self._values = None
+
+    @property
+    def values(self) -> dict:
+        if self._values is None:
+            with open(self.path, "r") as f:
+                self._values = json5.load(f)
+        return self._values
+
+    def reload(self): self._values = None
+
+    def __getitem__(self, key): return self.values[key]
+    def __setitem__(self, key, value): self.values[key] = value
+    def __delitem__(self, key): del self.values[key]
+    def __iter__(self): return iter(self.values)
+    def __len__(self): return len(self.values)
+
+
+class RunContext:
+    '''
+    output folder of one pipeline run, data/processed/dataN is only picked and created when first used
+    '''
+    def __init__(self, out_path=None):
+        self._out_path = out_path
+
+    @property
+    def started(self) -> bool: return self._out_path is not None
+
+    @property
+    def out_path(self) -> str:
+        if self._out_path is None:
+            self._out_path = next_output_folder()
+        os.makedirs(self._out_path, exist_ok=True)
+        return self._out_path
 
 
 # find next avaible output data folder
-i = 1
-while True:
-    candidate = os.path.join(OUTPUT_FOLDER, f"data{i}")
-    if os.path.isdir(candidate):
+def next_output_folder() -> str:
+    i = 1
+    while os.path.isdir(os.path.join(OUTPUT_FOLDER, f"data{i}")):
         i += 1
-    else:
-        os.makedirs(candidate, exist_ok=True)
-        OUT_PATH =  candidate
-        break
\ No newline at end of file
+    return os.path.join(OUTPUT_FOLDER, f"data{i}")
+
+
+# initiate settings as global variable, read lazily
+SETTINGS = Settings()
+
+_run_context = RunContext()
+
+
+def get_run_context() -> RunContext: return _run_context
+
+
+def set_run_context(context: RunContext):
+    global _run_context
+    _run_context = context
+
+
+def out_path() -> str: return _run_context.out_path
+
+
+def get_credentials():
+    # email and password for the HMD/HFD from .env
+    from dotenv import load_dotenv
+    load_dotenv()
+    return os.environ.get("EMAIL"), os.environ.get("PASSWORD")
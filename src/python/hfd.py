@@ -1,8 +1,9 @@
-import os, requests, zipfile, io
+import os
 import pandas as pd
-from bs4 import BeautifulSoup
-from src.python.helper import OUT_PATH, DOWNLOAD_FOLDER, EMAIL, PASSWORD, SETTINGS
-from src.python import log
+from src.python.helper import DOWNLOAD_FOLDER, SETTINGS, out_path, drop_edge_rows
+from src.python import log, cache, refresh, schema, profiler, table_io, selection
+from src.python.download import Source
+from src.python.hmd_hfd_reader import read_hfd_file
 
 
 login_url = "https://www.humanfertility.org/Account/Login"
@@ -10,63 +11,30 @@ download_url = "https://www.humanfertility.org/File/Download/Files/zip/asfr.zip"
 download_path = os.path.join(DOWNLOAD_FOLDER, "HFD")
 
 
-def download_hfd():
-    # run session to persist with cookies
-    with requests.Session() as s:
-        # get anti-forgery token
-        r = s.get(login_url, timeout=60)
-        r.raise_for_status()
-        soup = BeautifulSoup(r.text, "html.parser")
-        token = soup.find("input", {"name": "__RequestVerificationToken"}).get("value")
-        if not token:
-            log.error("could not fetch anti-forgery token for the HFD")
-            raise RuntimeError()
-        log.log("fetched anti-forgery token for the HFD")
-
-        # post login credentials and token
-        payload = {
-        "Email": EMAIL,
-        "Password": PASSWORD,
-        "__RequestVerificationToken": token
-        }
-
-        r = s.post(login_url, data=payload, timeout=60)
-        r.raise_for_status()
-        if "Logout" not in r.text and "Log out" not in r.text:
-            log.error("failed to login to the HFD")
-            raise RuntimeError()
-        log.log("successfully logged in to the HFD")
-
-        # download content
-        log.log("downloading .zip for HFD...")
-        r = s.get(download_url, timeout=60)
-        r.raise_for_status()
-        if not r.content:
-            log.error("could not download .zip content from the HFD")
-            raise RuntimeError()
-        log.log("successfully downloaded .zip from the HFD")
-
-        # extract .zip file to output directory
-        with zipfile.ZipFile(io.BytesIO(r.content)) as file:
-            file.extractall(download_path)
-        log.log("HFD .zip successfully extracted to: " + download_path)
+# only the RR asfr file is extracted, see find_hfd_file
+source = Source("HFD", download_url, login_url, download_path, lambda m: os.path.basename(m).endswith("RR.txt"))
 
 
-# get specified path for hfd and load into dataframe
-def load_hfd(path) -> pd.DataFrame:
+# downloads the hfd, skipped if unchanged since the last download
+def download_hfd(): refresh.refresh([source])
+
+
+# find the asfr .txt inside the extracted HFD directory
+def find_hfd_file(path) -> str:
     # TODO implement method to choose asfr - e.g. RR (registered births, resident mothers), TR (total births, resident mothers)
     asfr_type = "RR"
 
     # get file
     dirs = [f for f in os.listdir(path) if f.endswith(f"RR.txt")]
     if len(dirs) != 1: log.error(f"HFD files are indistinguishable or not found", path)
-    path = os.path.join(path, dirs[0])
+    return os.path.join(path, dirs[0])
 
-    df = pd.read_csv(
-        path, 
-        sep=r"\s+", # split if more than 1 space between columns 
-        engine="python",
-        skiprows=2)
+
+# get specified path for hfd and load into dataframe
+def load_hfd(path) -> pd.DataFrame:
+    path = find_hfd_file(path)
+    # C parser with explicit dtypes, age tokens parsed on read, only the selected populations and years are kept
+    df = cache.load("hfd", path, read_hfd_file, selection.rows("Code"))
 
     log.log("loaded the HFD into memory")
     return df
@@ -74,29 +42,29 @@ def load_hfd(path) -> pd.DataFrame:
 
 def format_hfd(df: pd.DataFrame) -> pd.DataFrame:
     df.rename(columns={"Code": "ISO3", "ASFR": "mx"}, inplace=True)
-    df["ISO3_suffix"] = df["ISO3"].str.slice(3).replace("",pd.NA)
-    df["ISO3"] = df["ISO3"].str.slice(0,3)
-    df["Age"] = pd.to_numeric(df["Age"].str.extract(r"(\d+)")[0], errors="coerce") # force age to be numeric, get rid of signs (e.g. +)
+    df["ISO3"], df["ISO3_suffix"] = schema.split_code(df["ISO3"]) # categorical, e.g. DEUTE -> DEU, TE
+    df = schema.apply(df)
 
     # drop first and last row of every group because 12- and 55+
     if SETTINGS["include_edge_data"] == False:
-        df = (
-            df.groupby(["ISO3", "ISO3_suffix" "Year"], group_keys=False)
-            .apply(lambda g: g.iloc[1:-1])
-        )
+        df = drop_edge_rows(df, ["ISO3", "ISO3_suffix", "Year"], head=1, tail=1)
 
     log.log("formatted the HFD")
     return df
 
 
+@profiler.profiled()
 def generate_hfd_df(download: bool):
+    if not selection.includes("HFD"):
+        log.log("HFD is not in the selected sources, skipped")
+        return pd.DataFrame()
     if download: download_hfd()
 
     raw_hfd_df = load_hfd(download_path)
     hfd_df = format_hfd(raw_hfd_df)
 
-    path = os.path.join(OUT_PATH, "hfd.csv")
-    hfd_df.to_csv(path, index=False)
+    path = os.path.join(out_path(), "hfd.csv")
+    table_io.write_table(hfd_df, path)
 
     log.log("successfully generated the HFD: " + path)
     return hfd_df
\ No newline at end of file
@@ -1,16 +1,33 @@
-import os
+import os, re, json
 import pandas as pd
-from src.python.helper import OUT_PATH, DOWNLOAD_FOLDER, SETTINGS
-from src.python import log
+from concurrent.futures import ProcessPoolExecutor
+from src.python.helper import DOWNLOAD_FOLDER, SETTINGS, out_path
+from src.python import log, cache, schema, profiler, table_io, selection
 
 
 # Path to hunter-gatherer data directory
 HG_DATA_DIR = os.path.join(DOWNLOAD_FOLDER, "HG")
+HG_SUFFIX = "HG" # ISO3_suffix of every hunter-gatherer population
+HG_YEAR = 1980 # placeholder year of the HG life tables
+
+# every table file in HG_DATA_DIR is a population, named by the part of the file name before " - ",
+# optional populations.json next to them sets the code and name of a file: {"Ache - Hurtado & Hill.xlsx": {"code": "ACH", "name": "Ache"}}
+MANIFEST_FILE = "populations.json"
+EXTENSIONS = (".xlsx", ".xls", ".csv")
+KNOWN_CODES = {"Ache": "ACH", "Hadza": "HDZ", "!Kung": "KUN"} # codes in use before the populations were discovered
 
 
 def load_hg_data(file_path: str) -> pd.DataFrame:
     """
-    Load hunter-gatherer data from Excel or CSV file.
+    Load hunter-gatherer data from Excel or CSV file, through the parsed file cache.
+    Expected format: Age, lx, mx columns
+    """
+    return cache.load("hg", file_path, parse_hg_data)
+
+
+def parse_hg_data(file_path: str) -> pd.DataFrame:
+    """
+    Parse hunter-gatherer data from Excel or CSV file.
     Expected format: Age, lx, mx columns
     """
     # Check file extension
@@ -56,7 +73,69 @@ def load_hg_data(file_path: str) -> pd.DataFrame:
     df['mx'] = df['mx'].fillna(0)
     
     log.log(f"loaded hunter-gatherer data into memory: {os.path.basename(file_path)}")
-    return df
+    # only the typed columns format_hg_data uses, so the cache never has to store mixed text columns
+    return df[['Age', 'lx', 'mx']].reset_index(drop=True)
+
+
+def population_code(name: str) -> str:
+    # known code, otherwise the first three letters of the name, e.g. Agta -> AGT
+    return KNOWN_CODES.get(name) or re.sub(r"[^A-Za-z]", "", name).upper()[:3]
+
+
+def discover_populations(folder: str = HG_DATA_DIR) -> list:
+    '''
+    (file path, code, name) of every population file in folder, sorted by file name,
+    codes and names come from populations.json where it lists the file
+    '''
+    if not os.path.isdir(folder): return []
+
+    manifest = {}
+    manifest_path = os.path.join(folder, MANIFEST_FILE)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f: manifest = json.load(f)
+
+    files = sorted(f for f in os.listdir(folder) if f.lower().endswith(EXTENSIONS) and not f.startswith("~$")) # ~$ are Excel lock files
+    for missing in sorted(set(manifest) - set(files)): log.warn(f"{MANIFEST_FILE} lists {missing}, which is not in {folder}")
+
+    populations, codes = [], {}
+    for filename in files:
+        entry = manifest.get(filename, {})
+        name = entry.get("name") or os.path.splitext(filename)[0].split(" - ")[0].strip()
+        code = (entry.get("code") or population_code(name)).upper()
+        if len(code) != 3: log.error(f"HG population {filename} has no 3 letter code, set one in {MANIFEST_FILE}", manifest_path)
+        if code in codes: log.error(f"HG populations {codes[code]} and {filename} both have the code {code}, set one in {MANIFEST_FILE}", manifest_path)
+        codes[code] = filename
+        populations.append((os.path.join(folder, filename), code, name))
+    return populations
+
+
+def parse_hg_files(paths: list, workers=None) -> dict:
+    '''
+    parsed table of every path, from the cache when the file content is unchanged,
+    the rest are parsed in a process pool (spreadsheet parsing is slow) and cached
+    '''
+    if workers is None: workers = SETTINGS.get("hg_workers", 4)
+    frames = {path: cache.lookup("hg", path) for path in paths}
+    missing = [path for path, df in frames.items() if df is None]
+    workers = max(1, min(workers, len(missing), os.cpu_count() or 1))
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, **log.worker_pool()) as pool: # workers log into this run's files
+            futures = {path: pool.submit(parse_hg_data, path) for path in missing}
+            parsed = {}
+            for path, future in futures.items():
+                try:
+                    parsed[path] = future.result()
+                except Exception as e: # reported here, a worker's own log lines are not relied on
+                    log.error(f"Error processing {os.path.basename(path)}: {str(e)}")
+    else:
+        parsed = {path: parse_hg_data(path) for path in missing}
+
+    for path, df in parsed.items():
+        cache.store("hg", path, df)
+        frames[path] = df
+    if missing: log.log(f"parsed {len(missing)} HG files ({len(paths) - len(missing)} from cache) with {workers} worker(s)")
+    return frames
 
 
 def format_hg_data(df: pd.DataFrame, population_code: str, population_name: str) -> pd.DataFrame:
@@ -78,8 +157,8 @@ def format_hg_data(df: pd.DataFrame, population_code: str, population_name: str)
     
     # Add identifying columns
     formatted['ISO3'] = population_code
-    formatted['ISO3_suffix'] = 'HG'  # All hunter-gatherers get 'HG' suffix
-    formatted['Year'] = 1980  # Placeholder year for HG populations
+    formatted['ISO3_suffix'] = HG_SUFFIX  # All hunter-gatherers get 'HG' suffix
+    formatted['Year'] = HG_YEAR  # Placeholder year for HG populations
     
     # Verify lx starts at 1.0 (with tolerance for floating point)
     lx_at_zero = formatted.loc[formatted['Age'] == 0, 'lx'].values
@@ -114,64 +193,46 @@ def format_hg_data(df: pd.DataFrame, population_code: str, population_name: str)
     return formatted
 
 
-def generate_hg_df() -> pd.DataFrame:
+@profiler.profiled()
+def generate_hg_df(workers=None) -> pd.DataFrame:
     """
     Generate formatted hunter-gatherer DataFrame.
     Combines all HG populations into single DataFrame.
     
-    Supports both.csv files 
+    Every .xlsx, .xls or .csv file in HG_DATA_DIR is a population (see discover_populations)
     """
-    
-    # Dictionary of HG populations
-    # Format: 'filename': ('ISO3_code', 'population_name')
-    # You can use EITHER .xlsx OR .csv files - just match your filename!
-    hg_populations = {
-        'Ache - Hurtado & Hill.csv': ('ACH', 'Ache'),
-        'Hadza - Blurton Jones data.csv': ('HDZ', 'Hadza'),
-        '!Kung - data.csv': ('KUN', '!Kung')
-    }
-    
+    if not selection.includes("HG"):
+        log.log("HG is not in the selected sources, skipped")
+        return pd.DataFrame()
+
+    # populations outside --countries/--suffixes/--years are never read
+    hg_populations = [p for p in discover_populations() if selection.includes_population(p[1], HG_SUFFIX, HG_YEAR)]
+    frames = parse_hg_files([path for path, _, _ in hg_populations], workers)
+
     all_hg_data = []
-    
-    for filename, (code, name) in hg_populations.items():
-        # Check if file exists in HG data directory
-        file_path = os.path.join(HG_DATA_DIR, filename)
-        
-        if os.path.exists(file_path):
-            log.log(f"processing {name} from {filename}...")
-            
-            try:
-                # Load and format data
-                raw_df = load_hg_data(file_path)
-                
-                if raw_df.empty:
-                    log.warn(f"No valid data loaded from {filename}")
-                    continue
-                
-                formatted_df = format_hg_data(raw_df, code, name)
-                all_hg_data.append(formatted_df)
-                
-            except Exception as e:
-                log.error(f"Error processing {filename}: {str(e)}")
-                continue
-        else:
-            log.warn(f"file not found: {filename}, skipping {name}")
+    for path, code, name in hg_populations:
+        raw_df = frames[path]
+        if raw_df.empty:
+            log.warn(f"No valid data loaded from {os.path.basename(path)}")
+            continue
+        log.log(f"processing {name} ({code}) from {os.path.basename(path)}...")
+        all_hg_data.append(format_hg_data(raw_df, code, name))
     
     if not all_hg_data:
         log.log("no hunter-gatherer data files found")
         log.log("Analysis will continue with HMD/HFD data only")
-        log.log(f"To add HG data: place CSV files in {HG_DATA_DIR}/")
+        log.log(f"To add HG data: place .xlsx or .csv files in {HG_DATA_DIR}/")
         return pd.DataFrame()
     
-    # Combine all HG populations
-    hg_df = pd.concat(all_hg_data, ignore_index=True)
+    # Combine all HG populations, with the same dtypes as the HMD/HFD tables
+    hg_df = schema.apply(pd.concat(all_hg_data, ignore_index=True))
     
     # Save to output
-    path = os.path.join(OUT_PATH, "hg.csv")
-    hg_df.to_csv(path, index=False)
+    path = os.path.join(out_path(), "hg.csv")
+    table_io.write_table(hg_df, path)
     
     log.log(f"successfully generated HG dataset: {path}")
-    log.log(f"  Total populations added: {len(hg_populations)}")
+    log.log(f"  Total populations added: {len(all_hg_data)}")
     log.log(f"  Total rows: {len(hg_df)}")
     
-    return hg_df
\ No newline at end of file
+    return hg_df
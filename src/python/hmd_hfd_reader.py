@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+from src.python import schema
+
+
+# columns as they appear in the HMD by_statistic life tables and the HFD asfr files
+HMD_DTYPES = {
+    "PopName": "category",
+    "Year": np.int16,
+    "Age": "category",
+    "mx": np.float64,
+    "qx": np.float64,
+    "ax": np.float64,
+    "lx": np.float64,
+    "dx": np.float64,
+    "Lx": np.float64,
+    "Tx": np.float64,
+    "ex": np.float64,
+}
+
+HFD_DTYPES = {
+    "Code": "category",
+    "Year": np.int16,
+    "Age": "category",
+    "ASFR": np.float64,
+}
+
+NA_VALUES = ["."] # HMD/HFD mark missing values with a single dot
+CHUNK_ROWS = 200_000 # rows parsed at a time when only a selection is kept
+
+
+def parse_age(age: pd.Series) -> pd.Series:
+    '''
+    turn categorical age tokens (e.g. 0, 110+, 12-, 55+) into int16,
+    only the distinct tokens are parsed so the cost does not grow with the row count
+    '''
+    tokens = age.cat.categories.astype(str)
+    values = pd.to_numeric(tokens.str.rstrip("+-"), errors="coerce")
+    return pd.Series(
+        np.asarray(values, dtype=np.float64)[age.cat.codes.to_numpy()],
+        index=age.index, name=age.name
+    ).astype("Int16" if np.isnan(values).any() else np.int16)
+
+
+def concat_chunks(chunks: list) -> pd.DataFrame:
+    # the categories of every chunk are its own, unite them so the columns stay categorical
+    first = chunks[0]
+    categorical = [c for c in first.columns if isinstance(first[c].dtype, pd.CategoricalDtype)]
+    dtypes = {c: pd.CategoricalDtype(union_categoricals([ch[c] for ch in chunks]).categories) for c in categorical}
+    return pd.concat([ch.astype(dtypes) for ch in chunks], ignore_index=True)
+
+
+def read_table(path, dtypes: dict, rows=None) -> pd.DataFrame:
+    '''
+    read a whitespace separated HMD/HFD text file with the C parser,
+    the first two lines are a title and a blank line,
+    with rows (a selection.RowFilter) the file is parsed in chunks and only the selected rows are kept
+    '''
+    options = dict(
+        sep=r"\s+", # handled natively by the C engine
+        engine="c",
+        skiprows=2,
+        dtype=dtypes,
+        na_values=NA_VALUES)
+
+    if rows is None:
+        df = pd.read_csv(path, **options)
+    else:
+        chunks = []
+        for chunk in pd.read_csv(path, chunksize=CHUNK_ROWS, **options):
+            keep = rows.mask(chunk)
+            if keep.any() or not chunks: chunks.append(chunk[keep])
+        df = schema.drop_unused_categories(concat_chunks(chunks))
+
+    df["Age"] = parse_age(df["Age"])
+    return df
+
+
+def read_hmd_file(path, rows=None) -> pd.DataFrame: return read_table(path, HMD_DTYPES, rows)
+def read_hfd_file(path, rows=None) -> pd.DataFrame: return read_table(path, HFD_DTYPES, rows)
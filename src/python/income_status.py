@@ -1,56 +1,86 @@
-import os, requests
+import os, re
 import pandas as pd
-from src.python.helper import OUT_PATH, DOWNLOAD_FOLDER, SETTINGS
-from src.python import log
+from src.python.helper import DOWNLOAD_FOLDER, SETTINGS, out_path
+from src.python import log, cache, refresh, profiler, table_io, selection
+from src.python.download import Source
 
 
 download_url = "https://ddh-openapi.worldbank.org/resources/DR0095334/download"
 download_path = os.path.join(DOWNLOAD_FOLDER, "WBLG", "WorldBank_Country_LendingGroups.xlsx")
 
 
-def download_income_status():
-    # no need to login for world bank
+# no need to login for world bank, the .xlsx is used as downloaded
+source = Source("WBLG", download_url, path=download_path)
 
-    with requests.Session() as s:
+SHEET = "Country Analytical History"
+ISO3_CODE = re.compile(r"^[A-Z]{3}$") # first cell of an economy's row
+MIN_YEARS = 5 # a header row has at least this many consecutive years
 
-        # download content
-        log.log("downloading .xlxs from the WBLG database...")
-        r = s.get(download_url, timeout=60)
-        r.raise_for_status()
-        if not r.content:
-            log.error("could not download .xlsx content from the WBLG")
-            raise RuntimeError()
 
-        # make sure output directory exists
-        path = os.path.dirname(download_path)
-        os.makedirs(path, exist_ok=True)
+# downloads the WBLG .xlsx, skipped if unchanged since the last download
+def download_income_status(): refresh.refresh([source])
 
-        # IMPORTANT: for world bank, path include file name.xlxs
-        path = download_path
-        with open(path, "wb") as f:
-            f.write(r.content)
-    
-        log.log("successfully downloaded .xlxs from the WBLG")
 
+def as_year(value):
+    # a header cell as a calendar year, None if it is not one
+    try:
+        year = int(float(value))
+    except (TypeError, ValueError):
+        return None
+    return year if 1900 <= year <= 2100 and float(value) == year else None
 
-def load_income_status(path) -> pd.DataFrame:
-    df = pd.read_excel(path, sheet_name="Country Analytical History")
-  
-    log.log("loaded the WBLG data into memory")
-    return df
 
+def header_years(row) -> tuple:
+    '''
+    (column of the first year, years) of the longest run of consecutive year cells in a row,
+    (None, []) when the row is not the year header ("Data for calendar year :" 1987 1988 ...)
+    '''
+    best, start, years = (None, []), None, []
+    for i, value in enumerate(row + (None,)):
+        year = as_year(value)
+        if year is not None and (not years or year == years[-1] + 1):
+            if not years: start = i
+            years.append(year)
+            continue
+        if len(years) > len(best[1]): best = (start, years)
+        start, years = (i, [year]) if year is not None else (None, [])
+    return best if len(best[1]) >= MIN_YEARS else (None, [])
 
-def format_income_status(df: pd.DataFrame) -> pd.DataFrame:
-    df = df.iloc[4:228].reset_index(drop=True) # grab subset of just data we want
-    df.drop(df.columns[1], axis=1, inplace=True) # drop country column, already hav iso3
 
-    # assign column names
-    years = df.iloc[0, 1:].tolist()
-    df.columns = ["ISO3"] + years; # asign names of columns 
+def load_income_status(path) -> pd.DataFrame:
+    '''
+    the ISO3 x year table of the Country Analytical History sheet, streamed by openpyxl in read-only mode:
+    the header is found as the row of years, then only the ISO3 column and the year columns of the economy rows under it are read
+    '''
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        sheet = workbook[SHEET]
+        for header, row in enumerate(sheet.iter_rows(values_only=True), start=1):
+            first, years = header_years(row)
+            if years: break
+        else:
+            log.error(f"no row of years in the {SHEET} sheet", path)
+
+        codes, values = [], []
+        for row in sheet.iter_rows(min_row=header + 1, max_col=first + len(years), values_only=True):
+            code = row[0].strip() if isinstance(row[0], str) else None
+            if code is not None and ISO3_CODE.match(code):
+                codes.append(code)
+                values.append(row[first:])
+            elif codes:
+                break # the economies are one block, notes follow it
+    finally:
+        workbook.close()
+
+    df = pd.DataFrame(values, columns=years)
+    df.insert(0, "ISO3", codes)
+    log.log(f"loaded the WBLG data into memory: {len(codes)} economies, {years[0]}-{years[-1]}")
+    return df
 
-    # drop unneeded header rows
-    df.drop(index=range(0, 6), inplace=True) # remove rows before start of data
 
+def format_income_status(df: pd.DataFrame) -> pd.DataFrame:
     # transpose the dataframe from wide to long
     df_long = df.melt(id_vars=["ISO3"], var_name="Year", value_name="IS")
     df_long["Year"] = df_long["Year"].astype(int)
@@ -65,14 +95,27 @@ def format_income_status(df: pd.DataFrame) -> pd.DataFrame:
     return df_long
 
 
+def parse_income_status(path, rows=None) -> pd.DataFrame:
+    df = format_income_status(load_income_status(path))
+    return df if rows is None else df[rows.mask(df)].reset_index(drop=True)
+
+
+def income_status_table() -> pd.DataFrame:
+    '''
+    the long ISO3, Year, IS table of the workbook, from the cache (keyed by the workbook's hash) unless the workbook changed,
+    only the selected countries and years are kept
+    '''
+    return cache.load("income_status", download_path, parse_income_status, selection.rows("ISO3", suffix=False))
+
+
+@profiler.profiled()
 def generate_income_status_df(download: bool):
     if download: download_income_status()
 
-    raw_income_status_df = load_income_status(download_path)
-    income_status_df = format_income_status(raw_income_status_df)
+    income_status_df = income_status_table()
 
-    path = os.path.join(OUT_PATH, "income_status.csv")
-    income_status_df.to_csv(path, index=False)
+    path = os.path.join(out_path(), "income_status.csv")
+    table_io.write_table(income_status_df, path)
 
     log.log("successfully generated the income status of countries: " + path)
     return income_status_df, path
@@ -1,60 +1,84 @@
 import os
+import numpy as np
 import pandas as pd
-from src.python import hmd, hfd, hg, log
-from src.python.helper import SETTINGS, OUT_PATH
-from src.python.helper import SETTINGS, OUT_PATH
+from src.python import hmd, hfd, hg, log, schema, profiler, table_io, selection
+from src.python.helper import SETTINGS, out_path
+
+
+NATIONAL_COLUMNS = [*schema.KEYS, "K", "ex", "lx", "mx"] # columns of the merged HMD/HFD table
+
+def changed(index: pd.MultiIndex, levels: int) -> np.ndarray:
+    # rows of a sorted index whose first levels differ from the previous row, read off the codes
+    out = np.zeros(len(index), dtype=bool)
+    out[:1] = True
+    for c in index.codes[:levels]: out[1:] |= c[1:] != c[:-1]
+    return out
+
+
+def sorted_index(df: pd.DataFrame, name: str) -> pd.DataFrame:
+    '''
+    df indexed and sorted by (ISO3, ISO3_suffix, Year, Age),
+    a repeated key would make reindex fail so only its first row is kept
+    '''
+    df = df.set_index(schema.KEYS)
+    if not df.index.is_monotonic_increasing: df = df.sort_index() # the HMD/HFD files are already sorted, no copy then
+    unique = changed(df.index, 4)
+    if not unique.all():
+        log.warn(f"{name}: {(~unique).sum()} duplicated (ISO3, ISO3_suffix, Year, Age) rows, keeping the first of each")
+        df = df[unique]
+    return df
 
-def merge_hmd_hfd_df(hmd_df: pd.DataFrame, hfd_df: pd.DataFrame):
-    # filter only common country, year pairs
-    common_df = pd.merge(
-        hmd_df[["ISO3", "ISO3_suffix","Year"]].drop_duplicates(),
-        hfd_df[["ISO3","ISO3_suffix","Year"]].drop_duplicates(),
-        on=["ISO3","ISO3_suffix", "Year"],
-        how="inner"
-        )
-    
-    #checking for duplicates despite the check 
-    dup_check = common_df.groupby(["ISO3", "ISO3_suffix", "Year"]).size()
-    if (dup_check > 1).any():
-        print("WARNING: Duplicates found in common_df:")
-        print(dup_check[dup_check > 1])
-    
 
-    # find all rows that exist in common
-    hmd_df = hmd_df.merge(common_df, on=["ISO3", "ISO3_suffix", "Year"], how="inner")
-    hfd_df = hfd_df.merge(common_df, on=["ISO3", "ISO3_suffix", "Year"], how="inner")
+def country_years(index: pd.MultiIndex) -> pd.MultiIndex:
+    # distinct (ISO3, ISO3_suffix, Year) of a sorted index
+    first = changed(index, 3)
+    return pd.MultiIndex(levels=index.levels[:3], codes=[c[first] for c in index.codes[:3]], names=index.names[:3])
+
+
+def age_grid(country_years: pd.MultiIndex, ages: np.ndarray) -> pd.MultiIndex:
+    # every country-year repeated for every age, built from the index codes without a cross join
+    return pd.MultiIndex(
+        levels=[*country_years.levels, ages],
+        codes=[*(np.repeat(c, len(ages)) for c in country_years.codes), np.tile(np.arange(len(ages)), len(country_years))],
+        names=schema.KEYS,
+        verify_integrity=False)
+
+
+def merge_hmd_hfd_df(hmd_df: pd.DataFrame, hfd_df: pd.DataFrame):
+    # same categories on both sides, otherwise the aligned keys fall back to object
+    hmd_df, hfd_df = schema.align_categories(hmd_df, hfd_df)
 
     # restrict HMD ages between min_age and max_age, adjust acordingly (max = 110)
-    hmd_df = hmd_df[hmd_df["Age"].between(SETTINGS["min_age"], SETTINGS["max_age"])]
+    in_range = hmd_df["Age"].between(SETTINGS["min_age"], SETTINGS["max_age"])
+    if not in_range.all(): hmd_df = hmd_df[in_range]
 
-    # building a full age grid min_age...max_age for each common (country, year)
-    ages = pd.DataFrame({"Age": list(range(SETTINGS["min_age"], SETTINGS["max_age"] + 1))})
-    grid = common_df.assign(_k=1).merge(ages.assign(_k=1), on="_k").drop(columns="_k")
-    
-    # merge lx (HMD) and asfr (HFD)
-    log.log(f"hmd_df DEU TE1956 Age 15 count: {len(hmd_df[(hmd_df['ISO3']=='DEU') & (hmd_df['ISO3_suffix']=='TE') & (hmd_df['Year']==1956) & (hmd_df['Age']==15)])}")
-    df = grid.merge(hmd_df, on=["ISO3", "ISO3_suffix", "Year", "Age"], how="left")
-    df = df.merge(hfd_df, on=["ISO3", "ISO3_suffix","Year", "Age"], how="left")
+    hmd_df = sorted_index(hmd_df, "HMD")
+    hfd_df = sorted_index(hfd_df, "HFD")
+
+    # filter only common country, year pairs
+    hmd_years = country_years(hmd_df.index)
+    common = hmd_years[hmd_years.isin(country_years(hfd_df.index))]
 
+    # full age grid min_age...max_age for each common (country, year), lx (HMD) and asfr (HFD) are aligned onto it
+    ages = np.arange(SETTINGS["min_age"], SETTINGS["max_age"] + 1, dtype=np.int16)
+    grid = age_grid(common, ages)
+    log.log(f"hmd_df DEU TE1956 Age 15 count: {int(('DEU', 'TE', 1956, 15) in hmd_df.index)}")
+    # both are reindexed onto the same grid object, so joining them is a plain column concat
+    df = pd.concat([hmd_df.reindex(grid), hfd_df.reindex(grid)], axis=1, copy=False)
+    df.reset_index(inplace=True)
 
-    # reorder
-    front = ["ISO3", "ISO3_suffix", "Year", "Age"]
-    df = df[[*front, *[c for c in df.columns if c not in front]]]
+    df = schema.apply(df)
 
     log.log("merged the HMD and HFD tables and separated ISO3 from the suffix")
     return df
 
 
-def generate_life_table(download: bool) -> str:
-    # generate formatted data from HMD and HFD
-    hmd_df = hmd.generate_hmd_df(download)
-    hfd_df = hfd.generate_hfd_df(download)
-    
-    # Generate HG data (no download needed, it's local)
-    hg_df = hg.generate_hg_df()
-
-    # merge data from HMD and HFD and export
-    hmd_hfd_df = merge_hmd_hfd_df(hmd_df, hfd_df)
+def combine_life_table(hmd_df: pd.DataFrame, hfd_df: pd.DataFrame, hg_df: pd.DataFrame) -> pd.DataFrame:
+    # merge data from HMD and HFD, there are no national rows when either is left out by --sources or the selection
+    if hmd_df.empty or hfd_df.empty:
+        hmd_hfd_df = schema.apply(pd.DataFrame(columns=NATIONAL_COLUMNS))
+    else:
+        hmd_hfd_df = merge_hmd_hfd_df(hmd_df, hfd_df)
     
     # ADD: Combine with HG data
     if not hg_df.empty:
@@ -66,20 +90,40 @@ def generate_life_table(download: bool) -> str:
         # Add missing columns to HG data with NaN (will be calculated by R)
         for col in all_columns:
             if col not in hg_df.columns:
-                hg_df[col] = None
+                hg_df[col] = np.nan
         
         # Ensure column order matches
         hg_df = hg_df[all_columns]
         
-        # Concatenate
-        combined_df = pd.concat([hmd_hfd_df, hg_df], ignore_index=True)
+        # Concatenate, categories are aligned first so the keys stay categorical
+        combined_df = schema.apply(pd.concat(schema.align_categories(hmd_hfd_df, hg_df), ignore_index=True))
         log.log(f"combined HMD/HFD with HG data: {len(hmd_hfd_df)} + {len(hg_df)} = {len(combined_df)} rows")
     else:
         combined_df = hmd_hfd_df
         log.log("no HG data to merge, using only HMD/HFD")
-    
-    path = os.path.join(OUT_PATH, "life_table.csv")
-    combined_df.to_csv(path, index=False)
+
+    if combined_df.empty: log.error(f"no life table rows in the selection ({selection.describe()})")
+    return combined_df
+
+
+def write_life_table(combined_df: pd.DataFrame) -> str:
+    path = os.path.join(out_path(), "life_table.csv")
+    table_io.write_table(combined_df, path)
     
     log.log("successfully generated the merged life table: " + path)
-    return path
\ No newline at end of file
+    return path
+
+
+@profiler.profiled()
+def generate_life_table(download: bool) -> pd.DataFrame:
+    # writes life_table.csv and returns the typed table, so generate_country_table doesn't have to read it back
+    # generate formatted data from HMD and HFD
+    hmd_df = hmd.generate_hmd_df(download)
+    hfd_df = hfd.generate_hfd_df(download)
+    
+    # Generate HG data (no download needed, it's local)
+    hg_df = hg.generate_hg_df()
+
+    combined_df = combine_life_table(hmd_df, hfd_df, hg_df)
+    write_life_table(combined_df)
+    return combined_df
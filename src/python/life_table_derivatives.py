@@ -0,0 +1,172 @@
+import os, shutil, subprocess, tempfile
+import numpy as np
+import pandas as pd
+from src.python import log, profiler, table_io
+
+
+DERIVATIVES_R = "src/R/life_table_derivatives.R"
+# expected derivatives of the synthetic life table, transcribed from the per-group loop of life_table_derivatives.R
+# rather than written by R, write_derivatives_fixture replaces it with the output of the R script
+DERIVATIVES_FIXTURE = "tests/fixtures/life_table_derivatives_reference.csv"
+
+# same columns, in the same order, as life_table_derivatives.R appends them
+DERIVATIVE_COLUMNS = ["dx", "N", "sx", "lxmx_STAND", "vx", "lxmx_STAND_SUM_qx", "lxmx", "mx_ADJ"]
+FIXTURE_COLUMNS = ["ISO3", "ISO3_suffix", "Year", "Age", *DERIVATIVE_COLUMNS]
+
+
+def calculate_derivatives(df: pd.DataFrame) -> pd.DataFrame:
+    '''
+    vectorized equivalent of life_table_derivatives.R, computed for every (ISO3, ISO3_suffix, Year) at once
+    rows keep their order, within a group the next row is the next age as in the R script
+    '''
+    missing = [c for c in ["ISO3", "Year", "Age", "lx", "mx"] if c not in df.columns]
+    if missing: log.error(f"missing required columns: {', '.join(missing)}")
+
+    keys = ["ISO3", "ISO3_suffix", "Year"]
+    group = df.groupby(keys, sort=False, dropna=False, observed=True).ngroup().to_numpy()
+    size = np.bincount(group)[group]
+
+    lx = pd.to_numeric(df["lx"], errors="coerce").to_numpy(dtype=np.float64)
+    mx = pd.to_numeric(df["mx"], errors="coerce").to_numpy(dtype=np.float64)
+
+    # groupby-aware shift: value of the next row in the same group, NaN on the last row
+    by_group = pd.Series(group)
+    def next_in_group(values): return pd.Series(values).groupby(by_group).shift(-1).to_numpy()
+
+    lx_next = next_in_group(lx)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # dx and sx (only for n_group - 1 elements)
+        dx = 1 - lx_next / lx
+        sx = 1 - dx
+
+        # Andy correction: lxmx calculations
+        lxmx = np.nan_to_num(lx * mx, nan=0.0)
+        lxmx_SUM = np.bincount(group, weights=lxmx)[group]
+        lxmx_STAND = lxmx / lxmx_SUM
+        mx_ADJ = lxmx_STAND / lx
+
+    # sum(lxmx_STAND[i:n]) as a reverse cumulative sum within each group
+    lxmx_STAND_SUM_qx = (
+        pd.Series(lxmx_STAND[::-1]).groupby(by_group[::-1].to_numpy()).cumsum().to_numpy()[::-1]
+    )
+
+    # vx (only for n_group - 1 elements)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        vx = next_in_group(lxmx_STAND_SUM_qx) ** 2 / lx_next ** 2
+
+    derived = {
+        "dx": dx, "N": lx * 1000, "sx": sx, "lxmx_STAND": lxmx_STAND, "vx": vx,
+        "lxmx_STAND_SUM_qx": lxmx_STAND_SUM_qx, "lxmx": lxmx, "mx_ADJ": mx_ADJ,
+    }
+
+    # groups with a single row are skipped by the R script, only N is filled
+    small = size < 2
+    out = df.copy()
+    for c in DERIVATIVE_COLUMNS:
+        values = derived[c]
+        if c != "N": values = np.where(small, np.nan, values)
+        out[c] = values
+
+    log.log(f"calculated life table derivatives for {len(np.unique(group))} groups")
+    return out
+
+
+@profiler.profiled()
+def generate_life_table_derivatives(life_table_df: pd.DataFrame, life_table_path) -> pd.DataFrame:
+    df = calculate_derivatives(life_table_df)
+    table_io.write_table(df, life_table_path)
+
+    log.log("successfully added derivatives to the life table: " + life_table_path)
+    return df
+
+
+def synthetic_life_table() -> pd.DataFrame:
+    '''
+    small life table for the parity tests: three populations (one without a suffix) over two years,
+    ages 0-60 with fertility at 12-55, a population that dies out (lx reaches 0), one with missing lx,
+    and a single row group that the R scripts skip (kept last)
+    '''
+    rng = np.random.default_rng(0)
+    ages = np.arange(61)
+    rows = []
+    for iso3, suffix in [("AAA", None), ("BBB", "TE"), ("BBB", "TW")]:
+        for year in range(2000, 2002):
+            lx = np.cumprod(np.r_[1.0, rng.uniform(0.9, 1.0, len(ages) - 1)])
+            mx = np.where((ages >= 12) & (ages <= 55), rng.uniform(0, 0.1, len(ages)), np.nan)
+            rows += [(iso3, suffix, year, a, lx[a], mx[a]) for a in ages]
+
+    # edge cases of the R loop: 0/0 after extinction, and NA in the middle of a group
+    lx = np.cumprod(np.r_[1.0, rng.uniform(0.8, 1.0, len(ages) - 1)])
+    lx[ages >= 40] = 0.0
+    mx = np.where((ages >= 12) & (ages <= 55), rng.uniform(0, 0.1, len(ages)), np.nan)
+    rows += [("DDD", None, 2000, a, lx[a], mx[a]) for a in ages]
+    lx = np.cumprod(np.r_[1.0, rng.uniform(0.9, 1.0, len(ages) - 1)])
+    lx[(ages >= 20) & (ages <= 22)] = np.nan
+    rows += [("EEE", "TE", 2000, a, lx[a], mx[a]) for a in ages]
+
+    rows.append(("CCC", None, 2000, 0, 1.0, np.nan)) # single row group
+    return pd.DataFrame(rows, columns=["ISO3", "ISO3_suffix", "Year", "Age", "lx", "mx"])
+
+
+def run_derivatives_R(df: pd.DataFrame):
+    # life_table_derivatives.R on df in a temporary folder, None when it fails
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "life_table.csv")
+        df.to_csv(path, index=False)
+        res = subprocess.run(["Rscript", DERIVATIVES_R, path], capture_output=True, text=True)
+        if res.returncode != 0:
+            log.warn(f"life_table_derivatives.R failed: {res.stderr.strip()}")
+            return None
+        return pd.read_csv(path)
+
+
+def write_derivatives_fixture():
+    '''
+    rewrite DERIVATIVES_FIXTURE from life_table_derivatives.R on the synthetic life table,
+    run this (needs Rscript) after changing the R script or synthetic_life_table
+    '''
+    expected = run_derivatives_R(synthetic_life_table())
+    if expected is None: log.error("could not write the derivatives fixture")
+    expected[FIXTURE_COLUMNS].to_csv(DERIVATIVES_FIXTURE, index=False, float_format="%.15g")
+    log.log(f"wrote {DERIVATIVES_FIXTURE}")
+
+
+def compare_derivatives(actual: pd.DataFrame, expected: pd.DataFrame, source: str) -> bool:
+    ok = len(actual) == len(expected) and (actual["Age"].to_numpy() == expected["Age"].to_numpy()).all()
+    for c in DERIVATIVE_COLUMNS:
+        same = ok and np.allclose(actual[c].to_numpy(dtype=np.float64), expected[c].to_numpy(dtype=np.float64), rtol=1e-9, equal_nan=True)
+        if not same: log.warn(f"  {c} differs between {source} and python")
+        ok = ok and same
+    return ok
+
+
+def test_derivatives_parity(life_table_path=None):
+    '''
+    compare calculate_derivatives with the output of life_table_derivatives.R
+    without a path: on the synthetic life table, against the reference table DERIVATIVES_FIXTURE, and against a live run of the R script when Rscript is on the PATH
+    with a path: on that life table, against a live run of the R script only (needs Rscript)
+    '''
+    log.log("Testing python life table derivatives against life_table_derivatives.R...")
+
+    df = pd.read_csv(life_table_path) if life_table_path is not None else synthetic_life_table()
+    actual = calculate_derivatives(df)
+
+    ok = True
+    if life_table_path is None:
+        ok = compare_derivatives(actual, pd.read_csv(DERIVATIVES_FIXTURE), "the reference table")
+        log.log(f"  python and the reference table agree: {ok}")
+
+    if shutil.which("Rscript") is None:
+        log.warn("Rscript not found, skipping the live R comparison")
+        return ok if life_table_path is None else None
+
+    expected = run_derivatives_R(df)
+    if expected is None: return False
+    same = compare_derivatives(actual, expected, "R")
+    log.log(f"  python and R derivatives agree: {same}")
+    return ok and same
+
+
+if __name__ == "__main__":
+    test_derivatives_parity()
@@ -1,22 +1,236 @@
-import os, sys
-from src.python.helper import get_datetimestamp, OUT_PATH
+import os, sys, json, time, atexit, threading
+from src.python.helper import SETTINGS, get_run_context
 
 
-LOG_FILE = "log_file.log"
-path = os.path.join(OUT_PATH, LOG_FILE)
+LOG_FILE = "log_file.log" # readable log of the run
+JSON_LOG_FILE = "log_file.jsonl" # the same records, one JSON object per line
 
+LEVELS = {"DEBUG": 10, "LOG": 20, "WARNING": 30, "ERROR": 40}
 
-# write logs to info file and print to terminal
-def write_log(level, message):
-    line = f"[{get_datetimestamp()}] {level}: {message}"
-    with open(path, "a") as f:
-        f.write(line + "\n")
-    print(line)
+FLUSH_SECONDS = 0.5 # longest a LOG line waits in the buffer, warnings and errors are written at once
+BUFFER_LINES = 1000 # wake the writer early when this many lines are waiting
+HELD_LINES = 10000 # most lines kept for the run folder before there is one, the oldest are dropped first
+CONSOLE = True # also print every line to the terminal
 
 
-def log(message):  write_log("LOG", message)
-def warn(message): write_log("WARNING", message)
-def error(message, path=None):
-    if path is not None: write_log("ERROR", f"{message}\n{path}")
-    else: write_log("ERROR", message)
-    sys.exit()
+class PipelineError(Exception):
+    '''
+    raised by error() after the message is logged, main.py stops the run on it
+    '''
+
+
+# log file of the current run, None until the run has an output folder
+def log_path(context=None):
+    context = context or get_run_context()
+    if not context.started: return None
+    return os.path.join(context.out_path, LOG_FILE)
+
+
+def format_time(seconds: float) -> str: return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(seconds))
+
+
+def append(path: str, text: str):
+    # O_APPEND puts every write at the end of the file, so whole lines from several processes never mix
+    data = text.encode()
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        while data:
+            data = data[os.write(fd, data):]
+    finally:
+        os.close(fd)
+
+
+class Writer:
+    '''
+    buffers log records in memory, formats and writes them in batches from a background thread,
+    so logging in a loop costs a list append instead of a file open and a print per call
+    '''
+    def __init__(self):
+        self.lock = threading.Lock() # guards pending, only held for an append or a swap
+        self.writing = threading.Lock() # keeps batches in order when two threads flush at once
+        self.wake = threading.Event()
+        self.pending = [] # (run context, time, level, message, fields)
+        self.thread = None
+        self.pid = os.getpid()
+        self.threshold = None
+        self.held = [] # (line, JSON record) logged before there was a run folder, written to the first one
+        self.worker = False # in a pool worker, see init_worker
+
+    def enabled(self, level: str) -> bool:
+        if self.threshold is None:
+            try:
+                self.threshold = LEVELS[str(SETTINGS.get("log_level", "LOG")).upper()]
+            except (OSError, ValueError, KeyError):
+                self.threshold = LEVELS["LOG"]
+        return LEVELS[level] >= self.threshold
+
+    def add(self, level: str, message: str, fields: dict):
+        entry = (get_run_context(), time.time(), level, message, fields)
+
+        if self.worker or os.getpid() != self.pid:
+            # a worker process: nothing flushes it in the background and it exits without atexit
+            with self.writing: return self.write([entry])
+
+        with self.lock:
+            self.pending.append(entry)
+            full = len(self.pending) >= BUFFER_LINES
+        if LEVELS[level] >= LEVELS["WARNING"]: return self.flush()
+        self.start()
+        if full: self.wake.set()
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="log-writer", daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            self.wake.wait(FLUSH_SECONDS)
+            self.wake.clear()
+            self.flush()
+
+    def flush(self):
+        with self.writing:
+            with self.lock:
+                entries, self.pending = self.pending, []
+            if entries: self.write(entries)
+
+    def write(self, entries):
+        # one write per file and one to the terminal for the whole batch
+        pid = os.getpid()
+        texts, records, contexts = [], [], {}
+        for context, seconds, level, message, fields in entries:
+            stamp = format_time(seconds)
+            texts.append(f"[{stamp}] {level}: {message}\n")
+            records.append(json.dumps({"time": stamp, "level": level, "message": message, "pid": pid, **fields}, default=str) + "\n")
+            contexts.setdefault(id(context), (context, []))[1].append(len(texts) - 1)
+
+        if CONSOLE:
+            sys.stdout.write("".join(texts))
+            sys.stdout.flush()
+
+        for context, rows in contexts.values():
+            lines = [(texts[i], records[i]) for i in rows]
+            path = log_path(context)
+            if path is None: # no run folder yet, keep the lines for the first one
+                self.held = (self.held + lines)[-HELD_LINES:]
+                continue
+            lines, self.held = self.held + lines, []
+            try:
+                append(path, "".join(text for text, _ in lines))
+                append(os.path.join(os.path.dirname(path), JSON_LOG_FILE), "".join(record for _, record in lines))
+            except OSError as e: # e.g. a temporary run folder that is already gone, the lines were still printed
+                sys.stderr.write(f"could not write to {path}: {e}\n")
+
+    def after_fork(self):
+        # the child gets a copy of the parent's buffer (the parent writes it) and no writer thread
+        self.lock = threading.Lock()
+        self.writing = threading.Lock()
+        self.wake = threading.Event()
+        self.pending = []
+        self.thread = None
+        self.held = []
+
+
+_writer = Writer()
+atexit.register(_writer.flush)
+if hasattr(os, "register_at_fork"): os.register_at_fork(after_in_child=_writer.after_fork)
+
+
+def set_level(level: str):
+    # lowest level that is written, overrides log_level in settings.json5
+    _writer.threshold = LEVELS[level.upper()]
+
+
+def flush(): _writer.flush()
+
+
+def init_worker(out_path, threshold):
+    # initializer of a process pool: spawned workers start without the run folder and the level set by the parent
+    from src.python.helper import RunContext, set_run_context
+    if out_path is not None: set_run_context(RunContext(out_path))
+    _writer.threshold = threshold
+    _writer.worker = True # write every line at once, a worker exits without flushing its buffer
+
+
+def worker_pool() -> dict:
+    # ProcessPoolExecutor arguments so the workers log into this run's files, e.g. ProcessPoolExecutor(4, **log.worker_pool())
+    context = get_run_context()
+    _writer.enabled("LOG") # resolves the threshold from the settings if it is not set yet
+    return {"initializer": init_worker, "initargs": (context.out_path if context.started else None, _writer.threshold)}
+
+
+# write logs to info file and print to terminal, extra fields only go to the JSON lines
+def write_log(level, message, **fields):
+    if _writer.enabled(level): _writer.add(level, str(message), fields)
+
+
+def debug(message, **fields): write_log("DEBUG", message, **fields)
+def log(message, **fields):   write_log("LOG", message, **fields)
+def warn(message, **fields):  write_log("WARNING", message, **fields)
+def error(message, path=None, **fields):
+    if path is not None: write_log("ERROR", f"{message}\n{path}", **fields)
+    else: write_log("ERROR", message, **fields)
+    raise PipelineError(message)
+
+
+def test_logger():
+    '''
+    buffered lines reach both files in order, levels filter, errors raise, lines from before the run folder
+    is known are kept for it, forked and spawned pool workers log into the same files
+    '''
+    import tempfile, multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from src.python.helper import RunContext, set_run_context
+
+    global CONSOLE
+    previous, threshold, console = get_run_context(), _writer.threshold, CONSOLE
+    fork = "fork" in multiprocessing.get_all_start_methods()
+    with tempfile.TemporaryDirectory() as tmp:
+        context = RunContext() # the run folder is not picked yet
+        set_run_context(context)
+        CONSOLE = False
+        try:
+            set_level("LOG")
+            log("before the run folder")
+            flush()
+            context._out_path = tmp # picked now, as out_path() does on first use
+
+            debug("not written")
+            start = time.perf_counter()
+            for i in range(10000): log(f"line {i}", i=i)
+            per_call = (time.perf_counter() - start) / 10000
+            try:
+                error("stopped")
+                raised = False
+            except PipelineError:
+                raised = True
+
+            if fork:
+                with ProcessPoolExecutor(max_workers=4, mp_context=multiprocessing.get_context("fork"), **worker_pool()) as pool:
+                    list(pool.map(log, [f"worker {i}" for i in range(400)]))
+            # spawned workers start without the run folder, the initializer passes it on
+            with ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context("spawn"), **worker_pool()) as pool:
+                list(pool.map(log, [f"spawned {i}" for i in range(40)]))
+            flush()
+
+            with open(os.path.join(tmp, LOG_FILE)) as f: lines = f.read().splitlines()
+            with open(os.path.join(tmp, JSON_LOG_FILE)) as f: records = [json.loads(l) for l in f]
+        finally:
+            set_run_context(previous)
+            _writer.threshold = threshold
+            CONSOLE = console
+
+    early = records[0]["message"] == "before the run folder"
+    ordered = [r["i"] for r in records if "i" in r] == list(range(10000))
+    workers = sum(1 for r in records if r["message"].startswith("worker")) == (400 if fork else 0)
+    spawned = sum(1 for r in records if r["message"].startswith("spawned")) == 40
+    ok = raised and early and ordered and workers and spawned and len(lines) == len(records) == 10042 + (400 if fork else 0) \
+        and not any("not written" in l for l in lines) and all(l.startswith("[") for l in lines)
+    print(f"  {per_call * 1e6:.1f}us per call, errors raise: {raised}, early lines kept: {early}, in order: {ordered}, "
+          f"forked worker lines intact: {workers}, spawned worker lines: {spawned}")
+    return ok
+
+
+if __name__ == "__main__":
+    print(f"logger test passed: {test_logger()}")
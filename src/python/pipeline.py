@@ -0,0 +1,167 @@
+import os, json, hashlib, shutil
+import pandas as pd
+from src.python.helper import OUTPUT_FOLDER, SETTINGS, out_path
+from src.python import log, cache, profiler
+
+
+STAGE_FOLDER = os.path.join(OUTPUT_FOLDER, "stages") # last outputs of every stage, shared between runs
+MANIFEST_FILE = os.path.join(STAGE_FOLDER, "manifest.json")
+
+
+class Stage:
+    '''
+    one step of the pipeline
+
+    name:     unique stage name
+    run:      function taking the results of earlier stages (dict of name -> value), returns this stage's value
+    outputs:  file names the stage writes into the run folder
+    deps:     names of stages whose results or outputs this stage uses
+    inputs:   raw files or directories the stage reads
+    code:     source files (python modules, R scripts) that define the stage
+    settings: keys of settings.json5 the stage depends on
+    load:     function rebuilding the stage's value from its output paths when the stage is skipped
+    '''
+    def __init__(self, name, run, outputs=(), deps=(), inputs=(), code=(), settings=(), load=None):
+        self.name = name
+        self.run = run
+        self.outputs = list(outputs)
+        self.deps = list(deps)
+        self.inputs = list(inputs)
+        self.code = list(code)
+        self.settings = list(settings)
+        self.load = load
+
+
+class Results(dict):
+    '''
+    stage results, values of skipped stages are only loaded from disk when asked for
+    '''
+    def __getitem__(self, name):
+        value = super().__getitem__(name)
+        if isinstance(value, Lazy):
+            value = value()
+            self[name] = value
+        return value
+
+
+class Lazy:
+    def __init__(self, load, paths):
+        self.load = load
+        self.paths = paths
+
+    def __call__(self): return self.load(*self.paths)
+
+
+def fingerprint_path(path) -> str:
+    if os.path.isdir(path):
+        h = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for f in sorted(files):
+                p = os.path.join(root, f)
+                h.update(f"{os.path.relpath(p, path)}:{cache.fingerprint(p)}".encode())
+        return h.hexdigest()
+    if os.path.isfile(path):
+        return cache.fingerprint(path)
+    return "missing"
+
+
+def fingerprint_stage(stage: Stage, upstream: dict) -> str:
+    content = {
+        "inputs": {str(p): fingerprint_path(p) for p in stage.inputs},
+        "code": {str(p): fingerprint_path(p) for p in stage.code},
+        "settings": {k: SETTINGS.get(k) for k in stage.settings},
+        "deps": {d: upstream[d] for d in stage.deps},
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def load_manifest() -> dict:
+    try:
+        with open(MANIFEST_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(manifest: dict):
+    os.makedirs(STAGE_FOLDER, exist_ok=True)
+    tmp = MANIFEST_FILE + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, MANIFEST_FILE)
+
+
+def snapshot_paths(stage: Stage, outputs) -> list:
+    return [os.path.join(STAGE_FOLDER, stage.name, f) for f in outputs]
+
+
+def snapshot(stage: Stage) -> list:
+    '''
+    copy the stage's outputs out of the run folder, later stages may rewrite the same files in place
+    '''
+    folder = os.path.join(STAGE_FOLDER, stage.name)
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder, exist_ok=True)
+
+    written = [f for f in stage.outputs if os.path.exists(os.path.join(out_path(), f))]
+    for f in written:
+        copy(os.path.join(out_path(), f), os.path.join(folder, f))
+    return written
+
+
+def copy(src, dst):
+    # an output is a file or a folder of files (e.g. the dashboard store), a folder replaces the old one
+    if os.path.isdir(src):
+        shutil.rmtree(dst, ignore_errors=True)
+        shutil.copytree(src, dst)
+    else:
+        shutil.copyfile(src, dst)
+
+
+def restore(stage: Stage, outputs):
+    for f, src in zip(outputs, snapshot_paths(stage, outputs)):
+        copy(src, os.path.join(out_path(), f))
+
+
+def is_current(entry, fingerprint: str, stage: Stage) -> bool:
+    if not entry or entry["fingerprint"] != fingerprint: return False
+    return all(os.path.exists(p) for p in snapshot_paths(stage, entry["outputs"]))
+
+
+def run(stages, force: bool = False) -> Results:
+    '''
+    run the stages in order, skipping any whose inputs, code, settings and upstream stages are unchanged
+    '''
+    manifest = load_manifest()
+    fingerprints = {}
+    results = Results()
+
+    for stage in stages:
+        fingerprint = fingerprint_stage(stage, fingerprints)
+        fingerprints[stage.name] = fingerprint
+        entry = manifest.get(stage.name)
+
+        if not force and is_current(entry, fingerprint, stage):
+            with profiler.section(stage.name, skipped=True):
+                restore(stage, entry["outputs"])
+            if stage.load is not None:
+                results[stage.name] = Lazy(stage.load, snapshot_paths(stage, entry["outputs"]))
+            else:
+                results[stage.name] = None
+            log.log(f"stage {stage.name}: unchanged, reused previous outputs")
+            continue
+
+        log.log(f"stage {stage.name}: running")
+        with profiler.section(stage.name, skipped=False) as section:
+            # raw files and the upstream tables already in memory (results of skipped stages are not loaded for this)
+            upstream = [dict.get(results, d) for d in stage.deps]
+            section.inputs(*stage.inputs, *[v for v in upstream if isinstance(v, pd.DataFrame)])
+            results[stage.name] = stage.run(results)
+            section.outputs(results[stage.name], *[os.path.join(out_path(), f) for f in stage.outputs])
+
+        manifest[stage.name] = {"fingerprint": fingerprint, "outputs": snapshot(stage)}
+        save_manifest(manifest)
+        log.log(f"stage {stage.name}: done")
+
+    return results
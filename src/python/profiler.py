@@ -0,0 +1,173 @@
+import os, sys, json, time, functools
+from contextlib import contextmanager
+import pandas as pd
+from src.python.helper import get_datetimestamp
+from src.python import log
+
+try:
+    import resource # not available on Windows, child and RSS figures are left out there
+except ImportError:
+    resource = None
+
+
+PROFILE_FILE = "profile.json" # written into the run folder
+CPROFILE_FILE = "profile.prof" # pstats file, when cProfile is on
+
+records = [] # one per finished section, in the order they finished
+_open = [] # sections currently running, outermost first
+_cprofile = None
+
+
+def rss_peak_mb():
+    # high-water mark of this process' RSS since the last reset_rss_peak
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"): return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if resource is None: return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024 # bytes on MacOS, KB on Linux
+
+
+def reset_rss_peak() -> bool:
+    # Linux only: writing 5 to clear_refs resets VmHWM, elsewhere the peak is the peak of the whole run so far
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def children():
+    # cpu seconds and largest RSS (MB) of the child processes that have finished so far, e.g. Rscript
+    if resource is None: return None, None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    scale = 1024 ** 2 if sys.platform == "darwin" else 1024
+    return usage.ru_utime + usage.ru_stime, usage.ru_maxrss / scale
+
+
+def size(item):
+    '''
+    (rows, bytes) of data frames (rows) and file or directory paths (bytes), or a list of them
+    '''
+    if item is None: return 0, 0
+    if isinstance(item, pd.DataFrame): return len(item), 0
+    if isinstance(item, (list, tuple)):
+        sizes = [size(i) for i in item]
+        return sum(r for r, _ in sizes), sum(b for _, b in sizes)
+    if isinstance(item, str) and os.path.isdir(item):
+        return 0, sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(item) for f in files)
+    if isinstance(item, str) and os.path.isfile(item):
+        return 0, os.path.getsize(item)
+    return 0, 0
+
+
+class Section:
+    '''
+    one timed part of a run, what goes in and out is added with inputs() and outputs()
+    '''
+    def __init__(self, name: str, parent=None, **fields):
+        self.record = {"name": name, "parent": parent, **fields,
+                       "rows_in": 0, "bytes_in": 0, "rows_out": 0, "bytes_out": 0}
+        self.peak = None
+
+    def inputs(self, *items):
+        rows, size_bytes = size(list(items))
+        self.record["rows_in"] += rows
+        self.record["bytes_in"] += size_bytes
+
+    def outputs(self, *items):
+        rows, size_bytes = size(list(items))
+        self.record["rows_out"] += rows
+        self.record["bytes_out"] += size_bytes
+
+    def see_peak(self, peak):
+        if peak is not None: self.peak = peak if self.peak is None else max(self.peak, peak)
+
+
+def fold_peak():
+    # hand the peak since the last reset to every open section, then start counting again
+    peak = rss_peak_mb()
+    for s in _open: s.see_peak(peak)
+    reset_rss_peak()
+
+
+@contextmanager
+def section(name: str, **fields):
+    '''
+    record wall time, cpu time, peak RSS and child process usage of the block,
+    sections nest (a generate_* function inside a pipeline stage) and each keeps its own peak
+    '''
+    fold_peak()
+    current = Section(name, _open[-1].record["name"] if _open else None, **fields)
+    _open.append(current)
+
+    child_cpu, _ = children()
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield current
+    finally:
+        fold_peak()
+        _open.pop()
+
+        record = current.record
+        record["wall_seconds"] = round(time.perf_counter() - wall, 4)
+        record["cpu_seconds"] = round(time.process_time() - cpu, 4)
+        record["peak_rss_mb"] = round(current.peak, 1) if current.peak is not None else None
+
+        end_cpu, child_peak = children()
+        if end_cpu is not None:
+            record["child_cpu_seconds"] = round(end_cpu - child_cpu, 4)
+            record["child_peak_rss_mb"] = round(child_peak, 1) # largest finished child so far
+        records.append(record)
+
+
+def profiled(name=None):
+    '''
+    decorator running a function in a section, its returned data frame(s) or file path are recorded as output
+    '''
+    def decorate(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with section(name or f.__name__) as s:
+                result = f(*args, **kwargs)
+                s.outputs(result)
+            return result
+        return wrapper
+    return decorate
+
+
+def start_cprofile():
+    global _cprofile
+    import cProfile
+    _cprofile = cProfile.Profile()
+    _cprofile.enable()
+
+
+def write(folder: str) -> str:
+    '''
+    write every recorded section to folder/profile.json (and the cProfile stats to folder/profile.prof)
+    '''
+    if _cprofile is not None:
+        _cprofile.disable()
+        _cprofile.dump_stats(os.path.join(folder, CPROFILE_FILE))
+        log.log(f"wrote cProfile stats: {os.path.join(folder, CPROFILE_FILE)} (python -m pstats)")
+
+    path = os.path.join(folder, PROFILE_FILE)
+    with open(path, "w") as f:
+        json.dump({"created": get_datetimestamp(), "argv": sys.argv, "sections": records}, f, indent=2)
+
+    log.log(f"wrote stage profile: {path}")
+    return path
+
+
+def summary() -> str:
+    # one line per top-level section, slowest first
+    top = sorted((r for r in records if r["parent"] is None), key=lambda r: -r["wall_seconds"])
+    return "\n".join(
+        f"  {r['name']:<22} {r['wall_seconds']:>9.2f}s wall {r['cpu_seconds']:>9.2f}s cpu"
+        + (f" {r['peak_rss_mb']:>8.0f} MB peak" if r["peak_rss_mb"] is not None else "")
+        for r in top)
@@ -0,0 +1,142 @@
+import os, shutil, subprocess, tempfile
+from src.python.helper import SETTINGS
+from src.python import log, table_io
+
+
+SESSION_R = "src/R/session.R"
+
+
+def find_rscript() -> str:
+    # Rscript on the PATH (MacOS/Linux), otherwise the default Windows install locations
+    path = shutil.which("Rscript")
+    if path: return path
+
+    version = SETTINGS["r_version"]
+    for candidate in (fr"C:\Program Files\R\{version}\bin\Rscript.exe", fr"C:\Program Files (x86)\R\{version}\bin\Rscript.exe"):
+        if os.path.exists(candidate): return candidate
+
+    log.error("could not find Rscript")
+
+
+class RSession:
+    '''
+    one long-lived R process (src/R/session.R) that runs the analysis scripts in sequence,
+    the tables the scripts read are parsed once and shared between them
+    '''
+    def __init__(self, *table_paths):
+        self.table_paths = [str(p) for p in table_paths]
+        self.process = None
+        self.tmp = None
+
+    def start(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.stderr = open(os.path.join(self.tmp.name, "session.err"), "w+")
+        self.process = subprocess.Popen(
+            [find_rscript(), "--vanilla", SESSION_R],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=self.stderr,
+            text=True,
+            bufsize=1 # line buffered
+        )
+        log.log("started R session")
+
+        # only the tables already written, e.g. the country table does not exist yet when the derivatives run first,
+        # the others are read by the first script that asks for them and cached from there
+        existing = [p for p in self.table_paths if table_io.table_exists(p)]
+        if not existing: return
+        status, elapsed = self.send("LOAD", *existing)
+        if status != 0:
+            log.error(f"R session could not load tables: {', '.join(existing)}")
+        log.log(f"R session loaded {len(existing)} tables in {elapsed:.2f}s")
+
+    def send(self, *fields):
+        self.process.stdin.write("\t".join(map(str, fields)) + "\n")
+        self.process.stdin.flush()
+
+        line = self.process.stdout.readline()
+        if not line.startswith("DONE"):
+            self.stderr.seek(0)
+            log.error(f"R session stopped unexpectedly. [R stderr] {self.stderr.read().strip()}")
+        _, status, elapsed = line.rstrip("\n").split("\t")
+        return int(status), float(elapsed)
+
+    def run(self, path: str, *args: str):
+        if self.process is None: self.start()
+
+        out = os.path.join(self.tmp.name, "script.out")
+        err = os.path.join(self.tmp.name, "script.err")
+        status, elapsed = self.send("RUN", path, out, err, *args)
+        log.log(f"ran R (session): {path} in {elapsed:.2f}s")
+
+        with open(out) as f: stdout = f.read().strip()
+        with open(err) as f: stderr = f.read().strip()
+
+        # same logging as main.run_r
+        if stdout:
+            log.log(stdout)
+        if stderr: # apparently some R packages write informative messages to stderr, so logging them to log.log, not to log.error
+            log.log(f"[R stderr] {stderr}")
+        if status != 0:
+            log.error(f"R script failed: {os.path.basename(path)} (exit {status}). [R stderr] {stderr}")
+
+    def close(self):
+        if self.process is None: return
+        try:
+            self.process.stdin.write("QUIT\n")
+            self.process.stdin.flush()
+            self.process.wait(timeout=30)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+        self.stderr.close()
+        self.tmp.cleanup()
+        self.process = None
+        log.log("closed R session")
+
+    def __enter__(self): return self
+    def __exit__(self, *exc): self.close()
+
+
+def test_session():
+    '''
+    drive session.R through LOAD, RUN and QUIT with Rscript: a table that does not exist yet is not loaded,
+    a script reads one table and writes it doubled to another, a second script reads what the first wrote
+    needs Rscript on the PATH
+    '''
+    import pandas as pd
+
+    log.log("Testing the R session...")
+    if shutil.which("Rscript") is None:
+        log.warn("Rscript not found, skipping R session test")
+        return None
+
+    script = """
+args <- commandArgs(trailingOnly = TRUE)
+x <- read_table(args[1])
+x[, value := value * 2]
+write_table(x, args[2])
+cat("rows:", nrow(x), "\\n")
+"""
+    with tempfile.TemporaryDirectory() as tmp:
+        first, second, third = (os.path.join(tmp, f"{name}.csv") for name in ("first", "second", "third"))
+        pd.DataFrame({"ISO3": ["AUS", "DEU"], "value": [1.0, 2.5]}).to_csv(first, index=False)
+        path = os.path.join(tmp, "double.R")
+        with open(path, "w") as f: f.write(script)
+
+        try:
+            with RSession(first, second) as session: # second is written by the first script
+                session.run(path, first, second)
+                session.run(path, second, third)
+                started = session.process is not None
+            session_closed = session.process is None
+        except log.PipelineError:
+            return False
+
+        values = pd.read_csv(third)["value"].tolist() == [4.0, 10.0]
+
+    log.log(f"  started without the unwritten table: {started}, values: {values}, closed: {session_closed}")
+    return started and values and session_closed
+
+
+if __name__ == "__main__":
+    test_session()
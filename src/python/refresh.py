@@ -0,0 +1,170 @@
+import os, json, time
+from concurrent.futures import ThreadPoolExecutor
+from src.python.helper import DOWNLOAD_FOLDER, SETTINGS, get_datetimestamp
+from src.python.download import Source, download_source
+from src.python import log, cache
+
+
+SOURCES_FILE = os.path.join(DOWNLOAD_FOLDER, "sources.json") # ETag, Last-Modified and sha256 of the last download of each source
+
+
+def default_sources() -> list:
+    from src.python import hmd, hfd, income_status # imported here, they import this module for download_*()
+    return [hmd.source, hfd.source, income_status.source]
+
+
+def load_manifest() -> dict:
+    try:
+        with open(SOURCES_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(manifest: dict):
+    os.makedirs(os.path.dirname(SOURCES_FILE), exist_ok=True)
+    tmp = SOURCES_FILE + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, SOURCES_FILE)
+
+
+def is_present(source: Source, entry) -> bool:
+    # the download and everything extracted from it are still on disk
+    if not entry or not os.path.exists(source.path): return False
+    return all(os.path.exists(os.path.join(source.destination, f)) for f in entry["files"])
+
+
+def conditional_headers(source: Source, entry) -> dict:
+    # only ask "has it changed?" when the last download is complete and still on disk
+    if not is_present(source, entry) or os.path.exists(source.path + ".part"): return {}
+
+    headers = {}
+    if entry.get("etag"): headers["If-None-Match"] = entry["etag"]
+    if entry.get("last_modified"): headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+
+def fetch(session, source: Source, entry) -> dict:
+    '''
+    conditionally download one source, returns its new manifest entry
+    '''
+    r, members = download_source(session, source, conditional_headers(source, entry))
+    if members is None:
+        log.log(f"{source.name} is unchanged upstream, kept the existing files")
+        return entry
+
+    checksum = cache.hash_file(source.path)
+    if entry and entry.get("sha256") == checksum:
+        log.log(f"{source.name} download is identical to the last one")
+
+    return {
+        "etag": r.headers.get("ETag"),
+        "last_modified": r.headers.get("Last-Modified"),
+        "sha256": checksum,
+        "files": members,
+        "downloaded": get_datetimestamp(),
+    }
+
+
+def refresh_source(source: Source, entry, retries: int, backoff: float) -> dict:
+    '''
+    fetch with its own session, retrying connection errors and 5xx responses with exponential backoff,
+    a retry resumes the partial download instead of starting again
+    '''
+    import requests # only needed for downloading, imported here so importing the module stays cheap
+
+    for attempt in range(retries + 1):
+        try:
+            with requests.Session() as s:
+                return fetch(s, source, entry)
+        except requests.RequestException as e:
+            status = e.response.status_code if e.response is not None else None
+            if attempt == retries or (status is not None and status < 500):
+                log.error(f"could not download the {source.name} after {attempt + 1} attempt(s): {e}")
+            wait = backoff * 2 ** attempt
+            log.warn(f"{source.name} download failed ({type(e).__name__}), retrying in {wait:.1f}s")
+            time.sleep(wait)
+
+
+def refresh(sources=None):
+    '''
+    bring the raw data up to date: every source is fetched concurrently with a conditional request,
+    so an unchanged source costs one round trip (after logging in) and is not extracted again
+    '''
+    sources = sources if sources is not None else default_sources()
+    manifest = load_manifest()
+    retries = SETTINGS.get("download_retries", 3)
+    backoff = SETTINGS.get("download_backoff", 1.0)
+
+    with ThreadPoolExecutor(max_workers=len(sources)) as pool:
+        futures = [(s, pool.submit(refresh_source, s, manifest.get(s.name), retries, backoff)) for s in sources]
+
+        # keep the sources that did refresh even if another one failed
+        failed = None
+        for source, future in futures:
+            try:
+                manifest[source.name] = future.result()
+            except Exception as e: # log.error raises PipelineError
+                failed = failed or e
+
+    save_manifest(manifest)
+    if failed is not None: raise failed
+    log.log(f"refreshed {', '.join(s.name for s in sources)}")
+    return manifest
+
+
+def test_refresh_offline():
+    '''
+    refresh two sources from local stand-in servers: first (interrupted) download, unchanged, then changed upstream
+    '''
+    import io, tempfile, zipfile
+    from tests.mock_server import MockServer
+
+    log.log("Testing conditional, concurrent refresh against local stand-in servers...")
+
+    def archive(text):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w") as z:
+            z.writestr("fltper_1x1/fltper_1x1.txt", text * 50000) # large enough for part of it to reach the disk before the cut
+            z.writestr("fltper_5x1/fltper_5x1.txt", "not needed\n")
+        return buffer.getvalue()
+
+    global SOURCES_FILE
+    hmd_v1 = archive("v1\n")
+    with tempfile.TemporaryDirectory() as tmp, \
+            MockServer({"/hmd.zip": hmd_v1}, drop_after=len(hmd_v1) // 2) as site, \
+            MockServer({"/wblg.xlsx": b"v1"}, login=False) as open_site:
+        sources_file, SOURCES_FILE = SOURCES_FILE, os.path.join(tmp, "sources.json")
+        sources = [
+            Source("HMD", site.url("/hmd.zip"), site.url("/Account/Login"), os.path.join(tmp, "HMD"),
+                   lambda m: os.path.basename(os.path.dirname(m)).endswith("_1x1"), os.path.join(tmp, "HMD.zip")),
+            Source("WBLG", open_site.url("/wblg.xlsx"), path=os.path.join(tmp, "WBLG", "wblg.xlsx")),
+        ]
+        extracted = os.path.join(tmp, "HMD", "fltper_1x1", "fltper_1x1.txt")
+        try:
+            refresh(sources) # the HMD download is cut off once, the retry resumes it
+            first = site.range_requests == 1 and os.path.exists(extracted) and open(sources[1].path, "rb").read() == b"v1"
+
+            # unchanged: one conditional request each, nothing re-extracted
+            mtime = os.stat(extracted).st_mtime_ns
+            before = (site.requests, open_site.requests)
+            refresh(sources)
+            unchanged = (site.not_modified, open_site.not_modified) == (1, 1) \
+                and open_site.requests - before[1] == 1 \
+                and os.stat(extracted).st_mtime_ns == mtime
+
+            # changed upstream: downloaded and extracted again
+            site.set_file("/hmd.zip", archive("v2\n"))
+            open_site.set_file("/wblg.xlsx", b"v2")
+            refresh(sources)
+            with open(extracted) as f: changed = f.read(3) == "v2\n" and open(sources[1].path, "rb").read() == b"v2"
+        finally:
+            SOURCES_FILE = sources_file
+
+    log.log(f"  first download: {first}, unchanged sources skipped: {unchanged}, changed sources refreshed: {changed}")
+    return first and unchanged and changed
+
+
+if __name__ == "__main__":
+    test_refresh_offline()
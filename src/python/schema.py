@@ -0,0 +1,110 @@
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+from src.python.helper import SETTINGS
+
+
+# dtypes shared by the HMD, HFD, HG and merged life tables
+KEYS = ["ISO3", "ISO3_suffix", "Year", "Age"]
+CATEGORY_COLUMNS = ["ISO3", "ISO3_suffix"]
+INTEGER_COLUMNS = {"Year": np.int16, "Age": np.int16}
+
+
+def float_dtype() -> np.dtype:
+    # "float64" (default) or "float32" to halve the memory of every value column
+    return np.dtype(SETTINGS.get("float_dtype", "float64"))
+
+
+def as_integer(s: pd.Series, dtype) -> pd.Series:
+    if s.isna().any(): return s.astype(pd.api.types.pandas_dtype(dtype.__name__.capitalize())) # nullable, e.g. Int16
+    return s.astype(dtype)
+
+
+def apply(df: pd.DataFrame, text=()) -> pd.DataFrame:
+    '''
+    cast df to the schema: categorical country codes, int16 Year and Age, every other column
+    (except those in text) to float_dtype(), object columns of numbers are coerced on the way
+    '''
+    floats = float_dtype()
+    columns = {}
+    for c in df.columns:
+        s = df[c]
+        if c in CATEGORY_COLUMNS:
+            if not isinstance(s.dtype, pd.CategoricalDtype): columns[c] = s.astype("category")
+        elif c in INTEGER_COLUMNS:
+            if s.dtype != INTEGER_COLUMNS[c]: columns[c] = as_integer(s, INTEGER_COLUMNS[c])
+        elif c not in text and s.dtype != floats:
+            columns[c] = pd.to_numeric(s, errors="coerce").astype(floats)
+    return df.assign(**columns) if columns else df
+
+
+def read_csv(path, text=()) -> pd.DataFrame:
+    '''
+    read a table written with this schema, parsing straight into the schema dtypes
+    so the keys never exist as object strings and the values never as float64 when float32 is set
+    '''
+    columns = pd.read_csv(path, nrows=0).columns
+    dtypes = {}
+    for c in columns:
+        if c in CATEGORY_COLUMNS: dtypes[c] = "category"
+        elif c in INTEGER_COLUMNS: dtypes[c] = INTEGER_COLUMNS[c]
+        elif c not in text: dtypes[c] = float_dtype()
+    return pd.read_csv(path, dtype=dtypes)
+
+
+def align_categories(*frames) -> list:
+    '''
+    give the categorical key columns of all frames the same (sorted) categories,
+    pandas only keeps a categorical through merge and concat when the categories match
+    '''
+    frames = list(frames)
+    for c in CATEGORY_COLUMNS:
+        present = [i for i, f in enumerate(frames) if c in f.columns]
+        if not present: continue
+        union = union_categoricals([pd.Categorical(frames[i][c]) for i in present], ignore_order=True)
+        dtype = pd.CategoricalDtype(union.categories.sort_values())
+        for i in present:
+            frames[i] = frames[i].assign(**{c: frames[i][c].astype(dtype)})
+    return frames
+
+
+def drop_unused_categories(df: pd.DataFrame) -> pd.DataFrame:
+    # after keeping a subset of the rows, so the categories only list values that are still there
+    columns = {c: df[c].cat.remove_unused_categories() for c in df.columns if isinstance(df[c].dtype, pd.CategoricalDtype)}
+    return df.assign(**columns) if columns else df
+
+
+def fill_category(s: pd.Series, value) -> pd.Series:
+    # fillna for a categorical that may not have value as a category yet
+    if isinstance(s.dtype, pd.CategoricalDtype) and value not in s.cat.categories:
+        s = s.cat.add_categories([value])
+    return s.fillna(value)
+
+
+def map_categories(s: pd.Series, f) -> pd.Series:
+    '''
+    apply f (e.g. str.upper) to the distinct values of a categorical instead of every row,
+    values that become equal are merged into one category
+    '''
+    s = s if isinstance(s.dtype, pd.CategoricalDtype) else s.astype("category")
+    categories, inverse = np.unique(np.asarray(f(s.cat.categories.astype(str)), dtype=object), return_inverse=True)
+    codes = s.cat.codes.to_numpy()
+    codes = np.where(codes >= 0, inverse[codes], -1)
+    return pd.Series(pd.Categorical.from_codes(codes, categories), index=s.index, name=s.name)
+
+
+def split_code(code: pd.Series):
+    '''
+    split HMD/HFD population codes (e.g. DEUTE) into ISO3 (DEU) and suffix (TE, missing if none),
+    done on the distinct codes so neither part is ever built as a column of strings
+    '''
+    code = code.astype("category")
+    tokens = code.cat.categories.astype(str)
+    rows = code.cat.codes.to_numpy()
+
+    def part(values):
+        parts = pd.Categorical(values)
+        codes = np.where(rows >= 0, parts.codes[rows], -1)
+        return pd.Series(pd.Categorical.from_codes(codes, parts.categories), index=code.index)
+
+    return part(tokens.str.slice(0, 3)), part(tokens.str.slice(3).where(tokens.str.len() > 3))
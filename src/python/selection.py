@@ -0,0 +1,145 @@
+import json, argparse
+import numpy as np
+import pandas as pd
+from src.python.helper import SETTINGS
+
+
+# settings.json5 keys of the subset a run processes, main.py --countries/--suffixes/--years/--sources override them,
+# the stages list them so a different subset never reuses the outputs of another
+KEYS = ["countries", "suffixes", "years", "sources"]
+SOURCES = ["HMD", "HFD", "HG"]
+NO_SUFFIX = "none" # --suffixes value for populations without a suffix (e.g. FRA next to FRATNP)
+
+
+def countries():
+    # selected ISO3 codes, None for all
+    values = SETTINGS.get("countries")
+    return {str(v).upper() for v in values} if values else None
+
+
+def suffixes():
+    # selected suffixes, "" for none, None for all
+    values = SETTINGS.get("suffixes")
+    if not values: return None
+    return {"" if str(v).lower() == NO_SUFFIX else str(v).upper() for v in values}
+
+
+def years():
+    # (first, last) selected year, either may be None for an open end, None for all
+    values = SETTINGS.get("years")
+    if not values: return None
+    first, last = values
+    return (None if first is None else int(first), None if last is None else int(last))
+
+
+def includes(source: str) -> bool:
+    values = SETTINGS.get("sources")
+    return not values or source.upper() in {str(v).upper() for v in values}
+
+
+def active() -> bool: return any(SETTINGS.get(k) for k in KEYS)
+
+
+def describe() -> str:
+    return ", ".join(f"{k}={SETTINGS.get(k)}" for k in KEYS if SETTINGS.get(k)) or "everything"
+
+
+def parse_years(text: str) -> list:
+    # argparse type of --years: 1950-2000, 1950 (one year), 1950- or -2000 (open ends)
+    first, sep, last = text.partition("-")
+    try:
+        first = int(first) if first else None
+        last = (int(last) if last else None) if sep else first
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"years must look like 1950-2000, 1950, 1950- or -2000, not {text}")
+    return [first, last]
+
+
+def apply_arguments(args):
+    # CLI options override the settings for this run
+    for k in KEYS:
+        value = getattr(args, k, None)
+        if value is not None: SETTINGS[k] = value
+
+
+def code_mask(codes: pd.Series, suffix: bool = True) -> np.ndarray:
+    '''
+    rows whose population code (e.g. DEUTE: ISO3 DEU, suffix TE) is selected,
+    decided once per distinct code and spread to the rows through the categorical codes
+    '''
+    codes = codes if isinstance(codes.dtype, pd.CategoricalDtype) else codes.astype("category")
+    tokens = codes.cat.categories.astype(str)
+    keep = np.ones(len(tokens), dtype=bool)
+    if countries() is not None: keep &= tokens.str.slice(0, 3).str.upper().isin(countries())
+    if suffix and suffixes() is not None: keep &= tokens.str.slice(3).str.upper().isin(suffixes())
+    rows = codes.cat.codes.to_numpy()
+    return np.where(rows >= 0, keep[rows], False)
+
+
+def year_mask(values: pd.Series) -> np.ndarray:
+    first, last = years() or (None, None)
+    keep = np.ones(len(values), dtype=bool)
+    if first is not None: keep &= (values >= first).to_numpy()
+    if last is not None: keep &= (values <= last).to_numpy()
+    return keep
+
+
+def includes_population(iso3: str, suffix: str, year: int) -> bool:
+    # for sources that are one population per file, checked before the file is read
+    if countries() is not None and iso3.upper() not in countries(): return False
+    if suffixes() is not None and (suffix or "").upper() not in suffixes(): return False
+    first, last = years() or (None, None)
+    return (first is None or year >= first) and (last is None or year <= last)
+
+
+class RowFilter:
+    '''
+    the selected rows of a raw table, found from its code and year columns only,
+    key names the subset, e.g. in the cache file of a table parsed with this filter
+    '''
+    def __init__(self, code_column: str, year_column: str = "Year", suffix: bool = True):
+        self.code_column = code_column
+        self.year_column = year_column
+        self.suffix = suffix
+        self.columns = [code_column, year_column]
+        subset = {"countries": sorted(countries() or []), "suffixes": sorted(suffixes() or []) if suffix else [], "years": years()}
+        self.key = json.dumps(subset, sort_keys=True)
+
+    def mask(self, df: pd.DataFrame) -> np.ndarray:
+        return code_mask(df[self.code_column], self.suffix) & year_mask(df[self.year_column])
+
+
+def rows(code_column: str, year_column: str = "Year", suffix: bool = True):
+    # RowFilter of the selection, None when every row is selected
+    if countries() is None and years() is None and (not suffix or suffixes() is None): return None
+    return RowFilter(code_column, year_column, suffix)
+
+
+def test_selection():
+    '''
+    population codes and years are selected per distinct code, open year ranges and "none" suffixes work
+    '''
+    from src.python import log
+
+    log.log("Testing the country/year selection...")
+    saved = {k: SETTINGS.get(k) for k in KEYS}
+    try:
+        for k, v in {"countries": ["deu", "FRA"], "suffixes": ["none", "TE"], "years": parse_years("1950-"), "sources": ["HMD", "HFD"]}.items():
+            SETTINGS[k] = v
+        df = pd.DataFrame({"PopName": pd.Categorical(["DEUTE", "DEUTW", "FRA", "FRATNP", "AUS", "DEUTE"]),
+                           "Year": [1956, 1956, 1949, 1990, 1990, 2000]})
+        codes = rows("PopName").mask(df).tolist() == [True, False, False, False, False, True]
+        ranges = parse_years("1950") == [1950, 1950] and parse_years("-2000") == [None, 2000]
+        sources = includes("hmd") and not includes("HG")
+        population = includes_population("FRA", "", 1990) and not includes_population("ACH", "HG", 1980)
+    finally:
+        for k, v in saved.items():
+            if v is None: SETTINGS.pop(k, None)
+            else: SETTINGS[k] = v
+
+    log.log(f"  codes: {codes}, year ranges: {ranges}, sources: {sources}, single populations: {population}")
+    return codes and ranges and sources and population
+
+
+if __name__ == "__main__":
+    test_selection()
@@ -0,0 +1,371 @@
+import os, shutil, subprocess
+import pandas as pd
+from src.python.helper import SETTINGS
+from src.python import log, cache, schema
+
+
+# every table is written as Feather (uncompressed Arrow IPC, memory-mapped by the readers in python and R)
+# next to its CSV; everywhere else a table is still named by its .csv path
+FEATHER_EXTENSION = ".feather"
+
+# tables named in partition_tables are written as a folder with one table per country instead,
+# e.g. life_table/ISO3=AUS/part.feather, listed in life_table/manifest.csv
+PARTITION_COLUMN = "ISO3"
+PARTITION_FILE = "part.csv"
+MANIFEST_FILE = "manifest.csv"
+STATS_COLUMNS = ["Year", "Age"] # min and max of these are kept per partition in the manifest
+
+
+def csv_path(path) -> str: return os.path.splitext(str(path))[0] + ".csv"
+def feather_path(path) -> str: return os.path.splitext(str(path))[0] + FEATHER_EXTENSION
+def dataset_path(path) -> str: return os.path.splitext(str(path))[0]
+def manifest_path(path) -> str: return os.path.join(dataset_path(path), MANIFEST_FILE)
+
+
+def files(name: str) -> list:
+    # file names a table can be written as, e.g. for the outputs of a pipeline stage
+    return [f"{name}.csv", f"{name}{FEATHER_EXTENSION}", name]
+
+
+def csv_export() -> bool: return SETTINGS.get("csv_export", True)
+
+
+def partitioned(path) -> bool: return os.path.basename(dataset_path(path)) in SETTINGS.get("partition_tables", [])
+
+
+def is_dataset(path) -> bool: return os.path.isfile(manifest_path(path))
+
+
+def table_exists(path) -> bool: return os.path.exists(csv_path(path)) or os.path.exists(feather_path(path)) or is_dataset(path)
+
+
+def remove(path):
+    if os.path.exists(path): os.remove(path)
+
+
+def write_feather(df: pd.DataFrame, path) -> bool:
+    if not cache.import_pyarrow(): return False
+    tmp = path + ".tmp"
+    try:
+        cache.feather.write_feather(cache.pa.Table.from_pandas(df, preserve_index=False), tmp, compression="uncompressed")
+    except (cache.pa.ArrowException, TypeError, ValueError) as e:
+        log.warn(f"could not write {os.path.basename(path)}, columns are not typed: {e}")
+        remove(tmp)
+        return False
+    os.replace(tmp, path)
+    return True
+
+
+def write_file(df: pd.DataFrame, path) -> str:
+    # one table file: Feather, and the CSV when exported (or without pyarrow)
+    path = csv_path(path)
+    feather = feather_path(path)
+
+    if not write_feather(df, feather): remove(feather)
+    if csv_export() or not os.path.exists(feather): df.to_csv(path, index=False)
+    else: remove(path)
+    return path
+
+
+def write_table(df: pd.DataFrame, path) -> str:
+    '''
+    write df to the Feather file of path, and to the CSV at path when csv_export is on (or without pyarrow),
+    or as a dataset of per-country partitions when the table is in partition_tables,
+    a file in the other format or layout left from an earlier write is removed so it can't be read instead
+    '''
+    path = csv_path(path)
+    if partitioned(path):
+        write_dataset(df, path)
+        remove(path)
+        remove(feather_path(path))
+        return path
+
+    if is_dataset(path): shutil.rmtree(dataset_path(path))
+    return write_file(df, path)
+
+
+def partition_fingerprint(rows: pd.DataFrame) -> str:
+    # changes with the values, the columns and the formats the partition is written in
+    values = int(pd.util.hash_pandas_object(rows, index=False).sum())
+    columns = int(pd.util.hash_array(rows.columns.to_numpy(dtype=object)).sum())
+    return f"{values:016x}{columns:016x}{int(csv_export())}"
+
+
+def partition_stats(rows: pd.DataFrame) -> dict:
+    stats = {}
+    for c in STATS_COLUMNS:
+        present = c in rows.columns and rows[c].notna().any()
+        stats[f"{c}_min"] = rows[c].min() if present else None
+        stats[f"{c}_max"] = rows[c].max() if present else None
+    return stats
+
+
+def read_manifest(path) -> pd.DataFrame:
+    return pd.read_csv(manifest_path(path), keep_default_na=False, na_values=[""], dtype={PARTITION_COLUMN: str, "fingerprint": str})
+
+
+def write_dataset(df: pd.DataFrame, path):
+    '''
+    write df as one table per country under dataset_path(path) and list them in the manifest
+    with their row counts and Year/Age ranges, partitions whose rows did not change are not rewritten
+    '''
+    folder = dataset_path(path)
+    previous = read_manifest(path) if is_dataset(path) else pd.DataFrame(columns=[PARTITION_COLUMN, "fingerprint"])
+    previous = dict(zip(previous[PARTITION_COLUMN], previous["fingerprint"]))
+    os.makedirs(folder, exist_ok=True)
+
+    records, written = [], 0
+    for value, rows in df.groupby(PARTITION_COLUMN, observed=True, sort=True):
+        part = os.path.join(f"{PARTITION_COLUMN}={value}", PARTITION_FILE)
+        fingerprint = partition_fingerprint(rows)
+        if previous.get(str(value)) != fingerprint or not table_exists(os.path.join(folder, part)):
+            os.makedirs(os.path.join(folder, os.path.dirname(part)), exist_ok=True)
+            write_file(rows.reset_index(drop=True), os.path.join(folder, part))
+            written += 1
+        records.append({PARTITION_COLUMN: value, "path": part.replace(os.sep, "/"), "rows": len(rows), **partition_stats(rows), "fingerprint": fingerprint})
+
+    # countries that are no longer in the table
+    current = {f"{PARTITION_COLUMN}={r[PARTITION_COLUMN]}" for r in records}
+    for entry in os.listdir(folder):
+        if entry.startswith(f"{PARTITION_COLUMN}=") and entry not in current: shutil.rmtree(os.path.join(folder, entry))
+
+    tmp = manifest_path(path) + ".tmp"
+    stats = [f"{c}_{stat}" for c in STATS_COLUMNS for stat in ("min", "max")]
+    pd.DataFrame(records, columns=[PARTITION_COLUMN, "path", "rows", *stats, "fingerprint"]).to_csv(tmp, index=False)
+    os.replace(tmp, manifest_path(path))
+    log.debug(f"wrote {os.path.basename(folder)}: {written} of {len(records)} partitions changed")
+
+
+def table_file(path) -> str:
+    # the file a table is read from, its Feather twin when there is one
+    feather = feather_path(path)
+    return feather if os.path.exists(feather) else csv_path(path)
+
+
+def read_file(path, read_csv=pd.read_csv) -> pd.DataFrame:
+    feather = feather_path(path)
+    if os.path.exists(feather) and cache.import_pyarrow():
+        return cache.feather.read_table(feather, memory_map=True).to_pandas()
+    return read_csv(csv_path(path))
+
+
+def read_dataset(path, read_csv=pd.read_csv, countries=None) -> pd.DataFrame:
+    # the partitions of the countries asked for (all without countries) as one table, in manifest order
+    manifest = read_manifest(path)
+    selected = manifest if countries is None else manifest[manifest[PARTITION_COLUMN].isin(countries)]
+    parts = [read_file(os.path.join(dataset_path(path), p), read_csv) for p in selected["path"]]
+    if not parts:
+        # none of these countries, no rows but the columns of the table (as a single file gives them)
+        if manifest.empty: return pd.DataFrame()
+        return read_file(os.path.join(dataset_path(path), manifest["path"].iloc[0]), read_csv).iloc[:0]
+    # every partition has its own categories, they have to match or concat falls back to object columns
+    if any(isinstance(parts[0][c].dtype, pd.CategoricalDtype) for c in schema.CATEGORY_COLUMNS if c in parts[0].columns):
+        parts = schema.align_categories(*parts)
+    return pd.concat(parts, ignore_index=True)
+
+
+def read_table(path, read_csv=pd.read_csv, countries=None) -> pd.DataFrame:
+    '''
+    read the table written at path (its .csv or .feather name), from the Feather file when there is one,
+    read_csv is used for the CSV, e.g. schema.read_csv to parse straight into the schema dtypes,
+    countries limits the rows to these ISO3 codes, a partitioned table only reads their partitions
+    '''
+    if is_dataset(path): return read_dataset(path, read_csv, countries)
+    df = read_file(path, read_csv)
+    if countries is not None: df = df[df[PARTITION_COLUMN].isin(countries)].reset_index(drop=True)
+    return df
+
+
+def loader(read=read_table):
+    # Stage.load for a table stage, gets the paths of the outputs the stage wrote (none for an empty table)
+    return lambda *paths: read(paths[0]) if paths else pd.DataFrame()
+
+
+def test_round_trip():
+    '''
+    a typed table read back from Feather keeps its dtypes, the CSV is only written when exported
+    '''
+    import tempfile
+    import numpy as np
+
+    log.log("Testing Feather table round trip...")
+    df = schema.apply(pd.DataFrame({
+        "ISO3": ["AUS", "AUS", "DEU"], "ISO3_suffix": [None, None, "TE"], "Year": [2000, 2000, 1956], "Age": [0, 1, 15],
+        "lx": [1.0, 0.99, np.nan]}))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "life_table.csv")
+        export = SETTINGS.get("csv_export")
+        try:
+            SETTINGS["csv_export"] = False
+            write_table(df, path)
+            feather_only = os.path.exists(feather_path(path)) and not os.path.exists(path)
+            same = read_table(path).equals(df) and read_table(feather_path(path)).dtypes.equals(df.dtypes)
+
+            SETTINGS["csv_export"] = True
+            write_table(df, path)
+            exported = os.path.exists(path) and schema.read_csv(path).equals(df)
+        finally:
+            if export is None: del SETTINGS["csv_export"]
+            else: SETTINGS["csv_export"] = export
+
+    log.log(f"  feather only without export: {feather_only}, dtypes kept: {same}, csv export: {exported}")
+    return feather_only and same and exported
+
+
+def test_partitions():
+    '''
+    a partitioned table reads back whole or per country, a rewrite only touches the countries that changed
+    '''
+    import tempfile
+    import numpy as np
+
+    log.log("Testing partitioned tables...")
+    df = schema.apply(pd.DataFrame({
+        "ISO3": ["AUS"] * 3 + ["DEU"] * 2 + ["FRA"], "ISO3_suffix": [None, None, None, "TE", "TE", None],
+        "Year": [2000, 2000, 2001, 1956, 1956, 1990], "Age": [0, 1, 0, 0, 1, 0],
+        "lx": [1.0, 0.99, 1.0, 1.0, np.nan, 1.0]}))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "life_table.csv")
+        tables = SETTINGS.get("partition_tables")
+        try:
+            SETTINGS["partition_tables"] = ["life_table"]
+            write_table(df, path)
+            whole = is_dataset(path) and not os.path.exists(path) and read_table(path).equals(df)
+            one = read_table(path, countries=["DEU"]).equals(df[df["ISO3"] == "DEU"].reset_index(drop=True))
+            none = read_table(path, countries=["ZZZ"])
+            one = one and none.empty and list(none.columns) == list(df.columns)
+            manifest = read_manifest(path)
+            counted = manifest["rows"].tolist() == [3, 2, 1] and manifest["Year_max"].tolist() == [2001, 1956, 1990]
+
+            aus = os.path.join(dataset_path(path), "ISO3=AUS", PARTITION_FILE)
+            before = os.stat(table_file(aus)).st_mtime_ns
+            changed = df[df["ISO3"] != "FRA"].assign(lx=lambda d: d["lx"].where(d["ISO3"] != "DEU", 0.5))
+            write_table(changed, path)
+            partial = os.stat(table_file(aus)).st_mtime_ns == before and read_table(path).equals(changed) \
+                and not os.path.exists(os.path.join(dataset_path(path), "ISO3=FRA"))
+
+            SETTINGS["partition_tables"] = []
+            write_table(df, path)
+            single = not os.path.exists(dataset_path(path)) and read_table(path, schema.read_csv).equals(df)
+        finally:
+            if tables is None: del SETTINGS["partition_tables"]
+            else: SETTINGS["partition_tables"] = tables
+
+    log.log(f"  whole: {whole}, one country: {one}, manifest: {counted}, unchanged partition kept: {partial}, back to one file: {single}")
+    return whole and one and counted and partial and single
+
+
+IO_TEST_R = """
+args <- commandArgs(trailingOnly = TRUE)
+source(args[1])
+if (args[3] == "no-arrow") has_arrow <- function() FALSE
+if (args[3] == "arrow" && !has_arrow()) quit(status = 3)
+
+x <- read_table(args[2])
+# missing ISO3_suffix is "" as fread gives it, whether read from the Feather file or the CSV
+stopifnot(identical(as.character(x$ISO3_suffix), c("", "", "TE")), identical(is.na(x$lx), c(FALSE, FALSE, TRUE)))
+x[, lx := lx * 2]
+write_table(x, args[2])
+"""
+
+
+IO_DATASET_TEST_R = """
+args <- commandArgs(trailingOnly = TRUE)
+source(args[1])
+
+stopifnot(nrow(read_table(args[2], countries = "DEU")) == 1)
+none <- read_table(args[2], countries = "ZZZ")
+stopifnot(nrow(none) == 0, "ISO3_suffix" %in% names(none))
+x <- read_table(args[2])
+stopifnot(nrow(x) == 3)
+x[, lx := lx * 2]
+write_table(x, args[2])
+"""
+
+
+def test_io_R():
+    '''
+    src/R/io.R with and without the arrow package: a table python wrote is read in R (from its Feather file
+    when arrow is there, otherwise the CSV) with a missing ISO3_suffix as "", the R rewrite is read back here
+    with the suffix missing again and no Feather file left that is older than the CSV,
+    a partitioned table is read in R for one country and for none, and its R rewrite is read back here
+    needs Rscript on the PATH, the arrow case also needs the arrow R package
+    '''
+    import tempfile
+    import numpy as np
+
+    log.log("Testing src/R/io.R against table_io...")
+    if shutil.which("Rscript") is None:
+        log.warn("Rscript not found, skipping io.R test")
+        return None
+
+    df = schema.apply(pd.DataFrame({
+        "ISO3": ["AUS", "AUS", "DEU"], "ISO3_suffix": [None, None, "TE"], "Year": [2000, 2000, 1956], "Age": [0, 1, 15],
+        "lx": [1.0, 0.99, np.nan]}))
+
+    ok = True
+    export = SETTINGS.get("csv_export")
+    with tempfile.TemporaryDirectory() as tmp:
+        script = os.path.join(tmp, "io_test.R")
+        with open(script, "w") as f: f.write(IO_TEST_R)
+
+        for mode in ("arrow", "no-arrow"):
+            path = os.path.join(tmp, mode, "life_table.csv")
+            os.makedirs(os.path.dirname(path))
+            try:
+                SETTINGS["csv_export"] = True # R falls back to the CSV without arrow
+                write_table(df, path)
+            finally:
+                if export is None: del SETTINGS["csv_export"]
+                else: SETTINGS["csv_export"] = export
+
+            res = subprocess.run(["Rscript", script, os.path.abspath("src/R/io.R"), path, mode], capture_output=True, text=True)
+            if res.returncode == 3:
+                log.warn("  arrow R package not installed, skipping the Feather case")
+                continue
+            if res.returncode != 0:
+                log.warn(f"  io.R {mode} failed: {res.stderr.strip()}")
+                ok = False
+                continue
+
+            back = read_table(path, schema.read_csv)
+            same = back["ISO3"].astype(str).tolist() == ["AUS", "AUS", "DEU"] \
+                and back["ISO3_suffix"].isna().tolist() == [True, True, False] \
+                and np.allclose(back["lx"].to_numpy(dtype=np.float64), df["lx"].to_numpy(dtype=np.float64) * 2, equal_nan=True)
+            no_stale = mode == "arrow" or not os.path.exists(feather_path(path))
+            log.log(f"  {mode}: read back in python: {same}, no stale feather: {no_stale}")
+            ok = ok and same and no_stale
+
+        # partitioned: R reads some countries or none, rewrites every partition and its manifest
+        script = os.path.join(tmp, "io_dataset_test.R")
+        with open(script, "w") as f: f.write(IO_DATASET_TEST_R)
+        path = os.path.join(tmp, "dataset", "life_table.csv")
+        tables = SETTINGS.get("partition_tables")
+        try:
+            SETTINGS["partition_tables"] = ["life_table"]
+            SETTINGS["csv_export"] = True
+            write_table(df, path)
+        finally:
+            if tables is None: del SETTINGS["partition_tables"]
+            else: SETTINGS["partition_tables"] = tables
+            if export is None: del SETTINGS["csv_export"]
+            else: SETTINGS["csv_export"] = export
+
+        res = subprocess.run(["Rscript", script, os.path.abspath("src/R/io.R"), path], capture_output=True, text=True)
+        if res.returncode != 0:
+            log.warn(f"  io.R dataset failed: {res.stderr.strip()}")
+            return False
+        back = read_table(path, schema.read_csv)
+        partitioned = is_dataset(path) and read_manifest(path)["rows"].tolist() == [2, 1] \
+            and np.allclose(back["lx"].to_numpy(dtype=np.float64), df["lx"].to_numpy(dtype=np.float64) * 2, equal_nan=True)
+        log.log(f"  dataset: countries read and rewrite read back in python: {partitioned}")
+
+    return ok and partitioned
+
+
+if __name__ == "__main__":
+    test_round_trip()
+    test_partitions()
+    test_io_R()
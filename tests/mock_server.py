@@ -0,0 +1,126 @@
+import hashlib, threading
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+
+LOGIN_PATH = "/Account/Login"
+TOKEN = "mock-anti-forgery-token"
+COOKIE = "mock_session=1"
+
+LOGIN_PAGE = f'<form><input name="__RequestVerificationToken" type="hidden" value="{TOKEN}" /></form>'
+
+
+class MockServer:
+    '''
+    local stand-in for the HMD/HFD/WBLG sites, used to test downloads offline
+
+    files:       url path -> bytes served at that path
+    login:       whether files need the login flow (anti-forgery token, then POST) first
+    drop_after:  cut the connection after this many bytes of the first full download
+    '''
+    def __init__(self, files: dict, login: bool = True, drop_after=None):
+        self.files = dict(files)
+        self.login = login
+        self.drop_after = drop_after
+        self.modified = formatdate(usegmt=True)
+
+        # counters the tests can check
+        self.requests = 0
+        self.logins = 0
+        self.range_requests = 0
+        self.not_modified = 0
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), self.handler())
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def url(self, path: str) -> str: return f"http://127.0.0.1:{self.httpd.server_port}{path}"
+
+    def set_file(self, path: str, content: bytes):
+        # change a file, as if it was updated upstream
+        self.files[path] = content
+        self.modified = formatdate(usegmt=True)
+
+    def etag(self, path: str) -> str: return '"' + hashlib.sha256(self.files[path]).hexdigest()[:16] + '"'
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args): pass # keep test output quiet
+
+            def send_body(self, status: int, body: bytes, headers=()):
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(body)))
+                for k, v in headers: self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                server.requests += 1
+                if self.path == LOGIN_PATH:
+                    return self.send_body(200, LOGIN_PAGE.encode())
+
+                if self.path not in server.files:
+                    return self.send_body(404, b"not found")
+                if server.login and COOKIE not in (self.headers.get("Cookie") or ""):
+                    return self.send_body(200, LOGIN_PAGE.encode()) # the real sites answer with the login page
+
+                etag = server.etag(self.path)
+                if self.not_modified(etag):
+                    server.not_modified += 1
+                    return self.send_body(304, b"", [("ETag", etag)])
+
+                content = server.files[self.path]
+                headers = [("ETag", etag), ("Last-Modified", server.modified), ("Accept-Ranges", "bytes")]
+
+                requested = self.headers.get("Range")
+                if requested and self.headers.get("If-Range") not in (None, etag, server.modified):
+                    requested = None # the client has another version, send the whole file
+                if requested:
+                    server.range_requests += 1
+                    start = int(requested.split("=")[1].split("-")[0])
+                    if start >= len(content):
+                        return self.send_body(416, b"", [("Content-Range", f"bytes */{len(content)}")])
+                    headers.append(("Content-Range", f"bytes {start}-{len(content) - 1}/{len(content)}"))
+                    return self.send_body(206, content[start:], headers)
+
+                if server.drop_after is not None:
+                    # announce the full length, then close the connection part way through
+                    cut, server.drop_after = server.drop_after, None
+                    self.send_response(200)
+                    self.send_header("Content-Length", str(len(content)))
+                    for k, v in headers: self.send_header(k, v)
+                    self.end_headers()
+                    self.wfile.write(content[:cut])
+                    self.wfile.flush()
+                    self.close_connection = True
+                    return
+
+                self.send_body(200, content, headers)
+
+            def not_modified(self, etag: str) -> bool:
+                # If-None-Match takes precedence over If-Modified-Since
+                if self.headers.get("If-None-Match"): return self.headers["If-None-Match"] == etag
+                since = self.headers.get("If-Modified-Since")
+                if not since: return False
+                return parsedate_to_datetime(since) >= parsedate_to_datetime(server.modified)
+
+            def do_POST(self):
+                server.requests += 1
+                length = int(self.headers.get("Content-Length", 0))
+                form = parse_qs(self.rfile.read(length).decode())
+                if self.path != LOGIN_PATH or form.get("__RequestVerificationToken") != [TOKEN]:
+                    return self.send_body(403, b"forbidden")
+                server.logins += 1
+                self.send_body(200, b"<a href='/Account/Logout'>Logout</a>", [("Set-Cookie", f"{COOKIE}; Path=/")])
+
+        return Handler